@@ -1,17 +1,34 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, has_request_context
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
-from difflib import get_close_matches
-from threading import Thread
+from difflib import SequenceMatcher
+from threading import Thread, Lock, BoundedSemaphore, local
+from queue import Queue, Full, Empty
+from collections import OrderedDict, Counter, namedtuple
 import os
+import io
 import requests
+from requests.adapters import HTTPAdapter
 import csv
 import pandas as pd
+import numpy as np
 import logging
 import traceback
 import sys
 import re
+import time
+import hmac
+import sqlite3
+import hashlib
+import json
+import mmap
+import pickle
+import random
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 
 app = Flask(__name__)
 
@@ -19,14 +36,284 @@ app = Flask(__name__)
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# ----------- 監控指標 -----------
+# 各處理階段的耗時（扣除內層階段後的淨耗時）、各意圖分支與錯誤次數，
+# 只在記錄時更新計數，/metrics 被抓取時才組成 Prometheus 文字格式
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Metrics:
+    """行程內的計數器與直方圖"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def add_collector(self, collect):
+        """註冊抓取時才計算的指標，collect() 回傳 [(名稱, 種類, 說明, [(標籤, 數值), ...]), ...]"""
+        self._collectors.append(collect)
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # 各區間次數 + 超出最大區間 + 總和 + 次數
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            hist[slot] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """輸出 Prometheus 文字格式"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms.items():
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), hist):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+
+        out = []
+        for name, lines in families.items():
+            kind, text = self._help.get(name, ("untyped", name))
+            out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + lines
+        for collect in self._collectors:
+            for name, kind, text, samples in collect():
+                out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                out += [f"{name}{self._labels(tuple(sorted(labels.items())))} {value}" for labels, value in samples]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics(METRIC_BUCKETS)
+metrics.describe("linebot_stage_seconds", "histogram", "Exclusive time spent in each processing stage")
+metrics.describe("linebot_intent_total", "counter", "Messages handled per intent branch")
+metrics.describe("linebot_errors_total", "counter", "Exceptions caught per location")
+
+_span_local = local()
+
+@contextmanager
+def span(stage: str):
+    """記錄一個處理階段的淨耗時（內層階段的時間會從外層扣除）"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    stack = getattr(_span_local, "stack", None)
+    if stack is None:
+        stack = _span_local.stack = []
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - start
+        child = stack.pop()
+        if stack:
+            stack[-1] += total
+        metrics.observe("linebot_stage_seconds", total - child, stage=stage)
+
+def timed(stage: str):
+    """將整個函式計入指定階段的裝飾器"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_intent(intent: str):
+    if METRICS_ENABLED:
+        metrics.inc("linebot_intent_total", intent=intent)
+
+def record_error(where: str):
+    metrics.inc("linebot_errors_total", where=where)
+
+# ----------- LINE API 連線池 -----------
+# 所有對 LINE API 的請求共用一個 keep-alive 連線池，限制同時送出的數量，
+# 遇到 429/5xx 或連線錯誤時以指數退避重試，總重試時間（含每次請求的逾時）不超過 reply token 的有效時間。
+# WEBHOOK_MODE=sync 時回覆是在 /callback 請求裡送出，退避等待會拖住 webhook 回應（LINE 逾時就會重送），
+# 因此請求內改用 LINE_SYNC_RETRY_BUDGET（預設 0，不重試）；背景工作池與排程腳本才用 LINE_RETRY_BUDGET
+
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+LINE_API_TIMEOUT = float(os.environ.get("LINE_API_TIMEOUT", "5"))
+LINE_POOL_SIZE = int(os.environ.get("LINE_POOL_SIZE", "10"))
+LINE_MAX_IN_FLIGHT = int(os.environ.get("LINE_MAX_IN_FLIGHT", "10"))
+LINE_MAX_RETRIES = int(os.environ.get("LINE_MAX_RETRIES", "3"))
+LINE_RETRY_BACKOFF = float(os.environ.get("LINE_RETRY_BACKOFF", "0.2"))
+LINE_RETRY_BUDGET = float(os.environ.get("LINE_RETRY_BUDGET", "20"))
+LINE_SYNC_RETRY_BUDGET = float(os.environ.get("LINE_SYNC_RETRY_BUDGET", "0"))
+
+class PooledHttpClient(RequestsHttpClient):
+    """共用連線池的 HttpClient：限制同時請求數，暫時性錯誤自動重試"""
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout=LINE_API_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LINE_POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._slots = BoundedSemaphore(LINE_MAX_IN_FLIGHT)
+        self._lock = Lock()
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _backoff(self, attempt: int, response):
+        """下次重試前要等待的秒數（優先採用 Retry-After）"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        return LINE_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _send(self, method: str, url: str, timeout=None, **kwargs):
+        """在同時請求上限內送出一次請求，回傳 (response, 連線錯誤)"""
+        with self._lock:
+            self.waiting += 1
+        with self._slots:
+            with self._lock:
+                self.waiting -= 1
+                self.in_flight += 1
+            try:
+                return self.session.request(method, url, timeout=timeout or self.timeout, **kwargs), None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                return None, e
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+    def _request(self, method: str, url: str, **kwargs):
+        budget = LINE_SYNC_RETRY_BUDGET if has_request_context() else LINE_RETRY_BUDGET
+        deadline = time.monotonic() + budget
+        # 下一次請求最久可能等到逾時，也要算進預算裡
+        timeout = kwargs.get("timeout") or self.timeout
+        attempt_time = sum(timeout) if isinstance(timeout, tuple) else timeout
+        attempt = 0
+        while True:
+            response, error = self._send(method, url, **kwargs)
+            status = str(response.status_code) if response is not None else "connection_error"
+            metrics.inc("linebot_line_api_requests_total", status=status)
+
+            retryable = error is not None or response.status_code in self.RETRY_STATUS
+            if not retryable or attempt >= LINE_MAX_RETRIES:
+                break
+            delay = self._backoff(attempt, response)
+            if time.monotonic() + delay + attempt_time > deadline:
+                break
+            metrics.inc("linebot_line_api_retries_total", reason=status)
+            time.sleep(delay)
+            attempt += 1
+
+        if error is not None:
+            raise error
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def collect_metrics(self):
+        """抓取 /metrics 時回報連線池使用狀況"""
+        with self._lock:
+            in_flight, waiting = self.in_flight, self.waiting
+        return [
+            ("linebot_line_api_in_flight", "gauge", "LINE API requests currently in flight", [({}, in_flight)]),
+            ("linebot_line_api_waiting", "gauge", "LINE API requests waiting for a free slot", [({}, waiting)]),
+            ("linebot_line_api_max_in_flight", "gauge", "Configured LINE API concurrency limit", [({}, LINE_MAX_IN_FLIGHT)]),
+            ("linebot_line_api_pool_size", "gauge", "Keep-alive connections kept per host", [({}, LINE_POOL_SIZE)]),
+        ]
+
+metrics.describe("linebot_line_api_requests_total", "counter", "LINE API responses by status code")
+metrics.describe("linebot_line_api_retries_total", "counter", "LINE API retries by reason")
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT,
+                          timeout=LINE_API_TIMEOUT, http_client=PooledHttpClient)
+metrics.add_collector(line_bot_api.http_client.collect_metrics)
+
 # 測試頁面
 @app.route("/")
 def home():
     return "Flask LINE Bot is running!"
 
+# 快取與工作池統計
+@app.route("/stats")
+def stats():
+    return {"reply_cache": reply_cache.stats(), "webhook": webhook_stats_snapshot(),
+            "dedup": {"size": len(recent_events), "maxsize": EVENT_DEDUP_SIZE}, "shedding": load_shedder.stats(),
+            "feeds": {feed.name: feed.stats() for feed in upstream_feeds}}
+
+# Prometheus 指標
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.before_request
+def ensure_background_threads():
+    start_price_watcher()
+    start_feed_fetcher()
+
+# 重新載入即時行情（需帶 X-Reload-Token），在背景解析後替換
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    token = request.headers.get("X-Reload-Token", "")
+    if not RELOAD_TOKEN or not hmac.compare_digest(token, RELOAD_TOKEN):
+        abort(403)
+
+    path = PRICE_XLS_PATH if request.args.get("source") == "xls" else PRICE_CSV_PATH
+    full = request.args.get("full") == "1"
+
+    def run():
+        try:
+            reload_price_data(path, full=full)
+        except Exception:
+            record_error("reload")
+            print(traceback.format_exc())
+
+    Thread(target=run, name="price-reload", daemon=True).start()
+    return 'Accepted', 202
+
 # LINE Webhook endpoint
 @app.route("/callback", methods=['POST', 'GET', 'OPTIONS'])
 def callback():
@@ -38,40 +325,705 @@ def callback():
     body = request.get_data(as_text=True)
 
     try:
-        handler.handle(body, signature)
+        with span("verify"):
+            events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
+        record_error("signature")
         abort(400)
 
+    for event in events:
+        # 重送的事件不再處理，也不佔用佇列
+        if is_duplicate_event(event):
+            count_webhook_event("duplicates")
+            continue
+        if WEBHOOK_MODE == "async":
+            # ✅ 先驗證簽章並排入佇列，立即回 200，由背景工作池處理回覆
+            enqueue_event(event)
+        else:
+            dispatch_event(event)
+
     return 'OK', 200
 
 # 回覆文字訊息
 logging.basicConfig(level=logging.ERROR)
 
-# 使用者狀態記錄
-user_state = {}
+# ----------- 共用儲存結構 -----------
+# 行程內的 LRU（回覆快取、使用者狀態、事件去重、限流共用）與 SQLite 檔案儲存的基底類別
+
+class LRUCache:
+    """容量有限的 LRU 快取（執行緒安全），可設定存活時間，並記錄命中/未命中次數"""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expires_at(self):
+        return None if self.ttl is None else time.monotonic() + self.ttl
+
+    def _live(self, key):
+        """取出未過期的項目（呼叫端需持有鎖），過期的順便刪除"""
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item
+
+    def _store(self, key, value):
+        self._data[key] = (value, self._expires_at())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._live(key)
+            if item is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def add(self, key, value):
+        """沒有未過期的同一鍵時才存入並回傳 True（檢查與存入在同一把鎖內完成）"""
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, value)
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteStore:
+    """SQLite 檔案儲存的基底：每個執行緒各自一條連線，建立時套用 SCHEMA"""
+
+    SCHEMA = ""
+    TIMEOUT = 5
+    PRAGMAS = ("journal_mode=WAL",)
+    ISOLATION_LEVEL = ""  # sqlite3 預設的交易模式；None 為自動提交
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        # gunicorn preload 時連線在主行程建立，fork 後的 worker 必須另開連線
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.TIMEOUT, isolation_level=self.ISOLATION_LEVEL)
+            for pragma in self.PRAGMAS:
+                conn.execute(f"PRAGMA {pragma}")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+class ExpiringSQLiteStore(SQLiteStore):
+    """有存活時間與數量上限的 SQLite 表：expires_at 欄位判斷過期，每寫入 SWEEP_EVERY 次清理一次，
+    超過上限時依 EVICT_ORDER 欄位由小到大淘汰"""
+
+    TABLE = ""
+    KEY = ""
+    EVICT_ORDER = "expires_at"
+    # 暫存資料，不需要每次寫入都 fsync
+    PRAGMAS = ("journal_mode=WAL", "synchronous=OFF")
+    ISOLATION_LEVEL = None
+    SWEEP_EVERY = 200
+
+    def __init__(self, path: str, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._writes = 0
+        super().__init__(path)
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self.sweep()
+
+    def sweep(self):
+        """刪除過期的資料，超過上限時淘汰 EVICT_ORDER 最小的資料"""
+        conn = self._conn()
+        conn.execute(f"DELETE FROM {self.TABLE} WHERE expires_at <= ?", (time.time(),))
+        excess = len(self) - self.maxsize
+        if excess > 0:
+            conn.execute(
+                f"DELETE FROM {self.TABLE} WHERE {self.KEY} IN "
+                f"(SELECT {self.KEY} FROM {self.TABLE} ORDER BY {self.EVICT_ORDER} LIMIT ?)", (excess,))
+
+    def __len__(self):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+# ----------- 使用者狀態記錄 -----------
+# 狀態有存活時間與數量上限；預設存在本機 SQLite，多個 gunicorn worker 共用同一份狀態
+
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite")  # sqlite 或 memory（僅限單一行程）
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL = float(os.environ.get("SESSION_TTL", "600"))
+SESSION_MAX_SIZE = int(os.environ.get("SESSION_MAX_SIZE", "10000"))
+
+class MemorySessionStore(LRUCache):
+    """行程內的使用者狀態（LRU + 存活時間）"""
+
+    def __setitem__(self, user_id, state):
+        if state is None:
+            self.pop(user_id)
+        else:
+            self.put(user_id, state)
+
+class SQLiteSessionStore(ExpiringSQLiteStore):
+    """以 SQLite 檔案保存的使用者狀態，多個 worker 行程共用（超過上限時淘汰最久沒更新的使用者）"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id    TEXT PRIMARY KEY,
+            state      TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state (updated_at);
+    """
+    TABLE, KEY, EVICT_ORDER = "user_state", "user_id", "updated_at"
+
+    def get(self, user_id, default=None):
+        row = self._conn().execute(
+            "SELECT state FROM user_state WHERE user_id = ? AND expires_at > ?", (user_id, time.time())).fetchone()
+        return row[0] if row else default
+
+    def __setitem__(self, user_id, state):
+        conn = self._conn()
+        if state is None:
+            conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+            return
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO user_state VALUES (?, ?, ?, ?)", (user_id, state, now + self.ttl, now))
+        self._wrote()
+
+def create_session_store():
+    """依 SESSION_BACKEND 建立狀態儲存，SQLite 無法使用時退回行程內記錄"""
+    if SESSION_BACKEND == "sqlite":
+        try:
+            return SQLiteSessionStore(SESSION_DB_PATH, SESSION_MAX_SIZE, SESSION_TTL)
+        except Exception as e:
+            print("❌ 無法開啟使用者狀態資料庫，改用行程內記錄:", e)
+    return MemorySessionStore(SESSION_MAX_SIZE, SESSION_TTL)
+
+user_state = create_session_store()
+
+# ----------- 啟動資料快照 -----------
+# 清理後的資料表與衍生索引在第一次啟動時寫入快照檔，之後的行程直接以 mmap 載入，不必重新解析 CSV。
+# 每個項目記錄來源檔的 SHA-256，來源、程式碼或 Python / pandas / numpy 版本有變動時自動重建；numpy 陣列以 out-of-band 緩衝區存放，
+# 載入後直接對應到檔案分頁（搭配 gunicorn preload，fork 出來的 worker 也共用同一份分頁）
+
+DATA_SNAPSHOT_ENABLED = os.environ.get("DATA_SNAPSHOT", "1") != "0"
+DATA_SNAPSHOT_PATH = os.environ.get("DATA_SNAPSHOT_PATH", "data_snapshot.bin")
+
+class DataSnapshot:
+    """快照檔格式：MAGIC | 標頭長度 | 標頭 JSON | 資料區（各項目的 pickle 與緩衝區，64 位元組對齊）"""
+
+    MAGIC = b"HSDSNAP1"
+    VERSION = 1
+    ALIGN = 64
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.values = {}
+        self.dirty = False
+        self._mmap = None
+        self._body = 0
+        self._digests = {}
+        self.code = self._code_digest()
+
+    def _code_digest(self):
+        """程式碼或 Python / pandas / numpy 版本變動時（pickle 的內部格式可能不同）舊快照一律作廢"""
+        versions = f"{sys.version}|{pd.__version__}|{np.__version__}"
+        with open(__file__, "rb") as f:
+            return hashlib.sha256(f.read() + versions.encode()).hexdigest()
+
+    def file_digest(self, path: str):
+        if path not in self._digests:
+            try:
+                with open(path, "rb") as f:
+                    self._digests[path] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                self._digests[path] = None
+        return self._digests[path]
+
+    def open(self):
+        """讀入並驗證快照檔；檔案不存在、校驗失敗或程式碼不同時視為空快照"""
+        try:
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return
+        try:
+            if mm[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("檔頭不符")
+            header_end = len(self.MAGIC) + 8 + int.from_bytes(mm[len(self.MAGIC):len(self.MAGIC) + 8], "little")
+            header = json.loads(mm[len(self.MAGIC) + 8:header_end])
+            if header.get("version") != self.VERSION or header.get("code") != self.code:
+                print("ℹ️ 程式碼或執行環境已更新，啟動資料快照將重建。")
+                return
+            body = memoryview(mm)[header["body"]:]
+            if hashlib.sha256(body).hexdigest() != header["sha256"]:
+                raise ValueError("校驗碼不符")
+        except Exception as e:
+            print(f"❌ 啟動資料快照無法使用，將重建（{e}）")
+            return
+        self._mmap = mm
+        self._body = header["body"]
+        self.entries = header["entries"]
+        print(f"✅ 已載入啟動資料快照（{len(self.entries)} 項，{len(mm) / 1024 / 1024:.1f} MiB）")
+
+    def _load_entry(self, entry):
+        view = memoryview(self._mmap)[self._body:]
+        offset, length = entry["pickle"]
+        buffers = [view[o:o + n] for o, n in entry["buffers"]]
+        return pickle.loads(view[offset:offset + length], buffers=buffers)
+
+    def get(self, name: str, sources, build):
+        """取得快照中的項目；來源檔有變動或讀取失敗時呼叫 build() 重建"""
+        fingerprint = [[path, self.file_digest(path)] for path in sources]
+        entry = self.entries.get(name)
+        if entry is not None and entry["sources"] == fingerprint:
+            try:
+                value = self._load_entry(entry)
+                self.values[name] = (fingerprint, value)
+                return value
+            except Exception as e:
+                print(f"❌ 快照項目 {name} 無法載入，將重建（{e}）")
+        value = build()
+        self.values[name] = (fingerprint, value)
+        self.dirty = True
+        return value
+
+    def save(self):
+        """有項目重建過時寫出新的快照檔（先寫暫存檔再 os.replace）"""
+        if not self.dirty:
+            return
+        chunks, entries, offset = [], {}, 0
+
+        def append(data):
+            nonlocal offset
+            pad = -offset % self.ALIGN
+            chunks.append(b"\0" * pad)
+            offset += pad
+            start = offset
+            chunks.append(data)
+            offset += len(data)
+            return [start, len(data)]
+
+        for name, (fingerprint, value) in self.values.items():
+            buffers = []
+            data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+            entries[name] = {
+                "sources": fingerprint,
+                "pickle": append(data),
+                "buffers": [append(buf.raw()) for buf in buffers],
+            }
+
+        body = b"".join(chunks)
+        header = {"version": self.VERSION, "code": self.code, "sha256": hashlib.sha256(body).hexdigest(),
+                  "entries": entries, "body": 0}
+        # 資料區從對齊的位置開始，標頭長度會影響資料區起點，因此先算出標頭再補齊
+        header_bytes = json.dumps(header).encode()
+        body_start = len(self.MAGIC) + 8 + len(header_bytes) + 32
+        body_start += -body_start % self.ALIGN
+        header["body"] = body_start
+        header_bytes = json.dumps(header).encode().ljust(body_start - len(self.MAGIC) - 8)
+
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(self.MAGIC + len(header_bytes).to_bytes(8, "little") + header_bytes)
+                f.write(body)
+            os.replace(tmp, self.path)
+            self.dirty = False
+            print(f"💾 已寫入啟動資料快照（{len(entries)} 項，{(body_start + len(body)) / 1024 / 1024:.1f} MiB）")
+        except OSError as e:
+            print("❌ 無法寫入啟動資料快照:", e)
+
+class NoSnapshot:
+    """停用快照時直接建置"""
+
+    def get(self, name: str, sources, build):
+        return build()
+
+    def save(self):
+        pass
+
+def create_data_snapshot():
+    if not DATA_SNAPSHOT_ENABLED:
+        return NoSnapshot()
+    snapshot = DataSnapshot(DATA_SNAPSHOT_PATH)
+    snapshot.open()
+    return snapshot
+
+data_snapshot = create_data_snapshot()
+
+# ----------- 即時行情資料（可熱重新載入） -----------
+# df 只會以整個快照替換：新資料在背景建好後一次指派，進行中的請求仍使用原本持有的快照
+
+PRICE_CSV_PATH = "水果產品日交易行情.csv"
+PRICE_XLS_PATH = "水果產品日交易行情.xls"
+PRICE_VALUE_COLS = ["上價", "中價", "下價", "平均價(元/公斤)"]
+# 監看行情檔的間隔秒數，0 表示不監看
+PRICE_RELOAD_INTERVAL = float(os.environ.get("PRICE_RELOAD_INTERVAL", "60"))
+# /admin/reload 使用的權杖，未設定時停用該端點
+RELOAD_TOKEN = os.environ.get("RELOAD_TOKEN", "")
+required_cols = ["日期", "市場", "產品", "平均價(元/公斤)", "價格增減%"]
+
+def normalize_price_columns(frame):
+    """去掉欄位名稱中的空白（含全形空白）與 BOM，例如「日　　期」→「日期」"""
+    frame.columns = frame.columns.str.replace(r'\s+', '', regex=True).str.replace('\ufeff', '')
+    return frame
+
+def read_price_file(path: str):
+    """讀取行情檔（CSV 或交易行情站匯出的 XLS），統一欄位名稱"""
+    if not path.lower().endswith(".xls"):
+        return normalize_price_columns(pd.read_csv(path, encoding="utf-8-sig"))
+
+    # XLS 前幾列是查詢條件，找到「日期」標題列後才是資料，最後一列是小計
+    raw = pd.read_excel(path, header=None, dtype=str)
+    first_col = raw[0].astype(str).str.replace(r"\s+", "", regex=True)
+    header_row = first_col[first_col == "日期"].index[0]
+    columns = raw.loc[header_row].astype(str).str.replace(r"\s+", "", regex=True).tolist()
+    # 兩個「增減%」欄位：第一個是價格增減，第二個是交易量增減
+    columns[columns.index("增減%")] = "價格增減%"
+
+    frame = raw.loc[header_row + 1:].copy()
+    frame.columns = columns
+    frame = frame[[c for c in columns if c and c != "nan"]]
+    frame = frame[frame["日期"].astype(str).str.match(r"^\d+/\d+/\d+$")]
+    for col in ["價格增減%", "增減%"]:
+        frame[col] = frame[col].astype(str).str.replace(r"[\s+]", "", regex=True).replace({"-": "0", "": "0"})
+    for col in PRICE_VALUE_COLS:
+        if col in frame.columns:
+            frame[col] = pd.to_numeric(frame[col], errors="coerce")
+    return frame.reset_index(drop=True)
+
+def add_price_derived_columns(frame):
+    """產生查詢用的 產品_clean / 產品_name_only 欄位"""
+    frame["產品_clean"] = frame["產品"].astype(str).str.replace(r"[\s　]+", "", regex=True)
+    frame["產品_name_only"] = frame["產品"].astype(str).str.replace(r"^\d+\s*", "", regex=True)
+    return frame
+
+def build_price_snapshot(path: str, base=None):
+    """讀取行情檔產生新快照；有 base 時只附加 base 尚未包含的交易日，回傳 (快照, 新增筆數)"""
+    frame = read_price_file(path)
+    if base is None or base.empty or "日期" not in base.columns:
+        return add_price_derived_columns(frame), len(frame)
+
+    held_dates = set(base["日期"].astype(str))
+    new_rows = frame[~frame["日期"].astype(str).isin(held_dates)].copy()
+    if new_rows.empty:
+        return base, 0
+    new_rows = add_price_derived_columns(new_rows)
+    return pd.concat([base, new_rows], ignore_index=True), len(new_rows)
+
+def file_mtime(path: str):
+    """取得檔案修改時間，檔案不存在時回傳 None"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+_price_reload_lock = Lock()
+_price_file_mtimes = {path: file_mtime(path) for path in (PRICE_CSV_PATH, PRICE_XLS_PATH)}
+
+def publish_price_snapshot(new_df, added: int):
+    """檢查欄位後替換 df，並把新增的列寫入歷史資料庫（呼叫端需持有 _price_reload_lock）"""
+    global df
+    if not all(col in new_df.columns for col in required_cols):
+        raise KeyError(f"欄位名稱不符，目前檔案欄位：{new_df.columns.tolist()}")
+    df = new_df
+    if price_store is not None and added:
+        price_store.ingest(new_df.tail(added))
+
+def reload_price_data(path: str = PRICE_CSV_PATH, full: bool = False):
+    """重新載入行情資料並原子替換 df；full=True 時捨棄舊資料整份重建，回傳新增筆數"""
+    with _price_reload_lock:
+        mtime = file_mtime(path)
+        new_df, added = build_price_snapshot(path, base=None if full else df)
+        publish_price_snapshot(new_df, added)
+        _price_file_mtimes[path] = mtime
+
+    rebuild_crop_matcher()
+    invalidate_reply_cache()
+    print(f"🔄 已重新載入即時行情資料（{path}），新增 {added} 筆，共 {len(new_df)} 筆。")
+    return added
+
+def check_price_files():
+    """檢查行情檔是否有更新，有變動就重新載入"""
+    for path in (PRICE_CSV_PATH, PRICE_XLS_PATH):
+        mtime = file_mtime(path)
+        if mtime is not None and mtime != _price_file_mtimes.get(path):
+            try:
+                reload_price_data(path)
+            except Exception:
+                _price_file_mtimes[path] = mtime
+                record_error("reload")
+                print(f"❌ 無法重新載入即時行情資料（{path}）:")
+                print(traceback.format_exc())
+
+def price_watcher():
+    """背景執行緒：定期檢查行情檔"""
+    while True:
+        time.sleep(PRICE_RELOAD_INTERVAL)
+        check_price_files()
+
+_watcher_pid = None
+# 只保護啟動本身；不可共用 _price_reload_lock，否則第一個請求會卡在整份行情重新載入後面
+_watcher_start_lock = Lock()
+
+def start_price_watcher():
+    """啟動行情檔監看執行緒（每個 gunicorn worker 各自一條）"""
+    global _watcher_pid
+    if PRICE_RELOAD_INTERVAL <= 0 or _watcher_pid == os.getpid():
+        return
+    with _watcher_start_lock:
+        if _watcher_pid == os.getpid():
+            return
+        Thread(target=price_watcher, name="price-watcher", daemon=True).start()
+        _watcher_pid = os.getpid()
 
 # 嘗試讀取 CSV
 try:
-    df = pd.read_csv("水果產品日交易行情.csv", encoding="utf-8-sig")
-    df.columns = df.columns.str.replace(r'\s+', '', regex=True).str.replace('\ufeff', '')
-    df["產品_clean"] = df["產品"].astype(str).str.replace(r"[\s　]+", "", regex=True)
-    df["產品_name_only"] = df["產品"].astype(str).str.replace(r"^\d+\s*", "", regex=True)
+    df = data_snapshot.get("df", [PRICE_CSV_PATH], lambda: add_price_derived_columns(read_price_file(PRICE_CSV_PATH)))
     print("✅ 成功讀入即時行情資料。")
 except Exception as e:
     print("❌ 無法讀入即時行情資料:", e)
     df = pd.DataFrame()
 
+# ----------- 行情歷史資料庫 -----------
+# 每日行情寫入 SQLite，以 (產品代碼, 市場代碼, 日期) 為主鍵，
+# 最新價、N 天均價與走勢都走索引查詢，不必掃描整份 DataFrame
+
+PRICE_DB_PATH = os.environ.get("PRICE_DB_PATH", "price_history.db")
+
+def roc_to_iso(roc_date: str):
+    """民國日期轉 ISO 格式（例如：114/11/01 → 2025-11-01）"""
+    m = re.match(r"^\s*(\d+)/(\d+)/(\d+)\s*$", str(roc_date))
+    if not m:
+        return None
+    year, month, day = (int(x) for x in m.groups())
+    return f"{year + 1911:04d}-{month:02d}-{day:02d}"
+
+def split_code(value: str):
+    """拆出前綴代碼與名稱（例如："A1 香蕉" → ("A1", "香蕉")）"""
+    text = str(value).strip()
+    parts = text.split(None, 1)
+    if len(parts) == 2 and re.match(r"^[A-Z]?\d+$", parts[0]):
+        return parts[0], parts[1].strip()
+    return text, text
+
+def to_float(value):
+    try:
+        return float(str(value).replace(",", ""))
+    except ValueError:
+        return None
+
+class PriceHistoryStore(SQLiteStore):
+    """SQLite 行情歷史資料（每個執行緒各自一條連線）"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS price_history (
+            product_code TEXT NOT NULL,
+            market_code  TEXT NOT NULL,
+            trade_date   TEXT NOT NULL,
+            roc_date     TEXT NOT NULL,
+            product      TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            market       TEXT NOT NULL,
+            market_name  TEXT NOT NULL,
+            high REAL, mid REAL, low REAL,
+            avg_price    REAL,
+            price_change REAL,
+            volume       REAL,
+            PRIMARY KEY (product_code, market_code, trade_date)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_price_history_date ON price_history (trade_date);
+    """
+
+    TIMEOUT = 10
+    PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL")
+
+    def __init__(self, path: str):
+        self._products = None
+        self._markets = None
+        super().__init__(path)
+
+    def ingest(self, frame):
+        """寫入行情資料（同一產品、市場、日期重複時以新資料為準），回傳寫入筆數"""
+        if frame is None or frame.empty:
+            return 0
+        rows = []
+        for record in frame[required_cols + ["上價", "中價", "下價", "交易量(公斤)"]].itertuples(index=False):
+            roc_date, market, product, avg_price, change, high, mid, low, volume = record
+            trade_date = roc_to_iso(roc_date)
+            if trade_date is None:
+                continue
+            product_code, product_name = split_code(product)
+            market_code, market_name = split_code(market)
+            rows.append((product_code, market_code, trade_date, str(roc_date).strip(), str(product), product_name,
+                         str(market), market_name, to_float(high), to_float(mid), to_float(low),
+                         to_float(avg_price), to_float(change), to_float(volume)))
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO price_history VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        self._products = None
+        self._markets = None
+        return len(rows)
+
+    def products(self):
+        """所有產品代碼與名稱（快取，寫入新資料後重建）"""
+        if self._products is None:
+            self._products = self._conn().execute(
+                "SELECT DISTINCT product_code, product_name FROM price_history").fetchall()
+        return self._products
+
+    def markets(self):
+        """所有市場名稱（快取，寫入新資料後重建）"""
+        if self._markets is None:
+            self._markets = [r[0] for r in self._conn().execute("SELECT DISTINCT market_name FROM price_history")]
+        return self._markets
+
+    def find_codes(self, keyword: str):
+        """以產品名稱（不含代碼）比對，找不到再比對含代碼的完整名稱"""
+        needle = keyword.lower()
+        products = self.products()
+        codes = [code for code, name in products if needle in name.lower()]
+        if not codes:
+            codes = [code for code, name in products if needle in re.sub(r"\s+", "", f"{code}{name}").lower()]
+        return codes
+
+    def _where(self, codes, market_name=None):
+        sql = f"product_code IN ({','.join('?' * len(codes))})"
+        params = list(codes)
+        if market_name:
+            sql += " AND market_name = ?"
+            params.append(market_name)
+        return sql, params
+
+    def latest_date(self, codes, market_name=None):
+        where, params = self._where(codes, market_name)
+        row = self._conn().execute(f"SELECT MAX(trade_date) FROM price_history WHERE {where}", params).fetchone()
+        return row[0]
+
+    @timed("query")
+    def latest(self, codes, market_name=None):
+        """最新交易日的行情，回傳 (民國日期, 資料列)"""
+        if not codes:
+            return None, []
+        latest = self.latest_date(codes, market_name)
+        if latest is None:
+            return None, []
+        where, params = self._where(codes, market_name)
+        rows = self._conn().execute(
+            f"SELECT roc_date, product, market, avg_price, price_change FROM price_history "
+            f"WHERE {where} AND trade_date = ? ORDER BY market_code, product_code", params + [latest]).fetchall()
+        return rows[0][0], rows
+
+    @timed("query")
+    def average(self, codes, days: int, market_name=None):
+        """最近 N 天（以最新交易日往回算）各產品、市場的平均價"""
+        if not codes:
+            return []
+        latest = self.latest_date(codes, market_name)
+        if latest is None:
+            return []
+        where, params = self._where(codes, market_name)
+        return self._conn().execute(
+            f"SELECT product, market, AVG(avg_price), COUNT(*), MIN(roc_date), MAX(roc_date) FROM price_history "
+            f"WHERE {where} AND trade_date >= date(?, ?) AND trade_date <= ? "
+            f"GROUP BY product_code, market_code ORDER BY market_code, product_code",
+            params + [latest, f"-{days - 1} days", latest]).fetchall()
+
+    @timed("query")
+    def trend(self, codes, days: int, market_name=None):
+        """最近 N 天各產品、市場的每日均價，回傳 [(產品, 市場, [(民國日期, 均價), ...]), ...]"""
+        if not codes:
+            return []
+        latest = self.latest_date(codes, market_name)
+        if latest is None:
+            return []
+        where, params = self._where(codes, market_name)
+        rows = self._conn().execute(
+            f"SELECT product_code, market_code, product, market, roc_date, avg_price FROM price_history "
+            f"WHERE {where} AND trade_date >= date(?, ?) AND trade_date <= ? "
+            f"ORDER BY market_code, product_code, trade_date",
+            params + [latest, f"-{days - 1} days", latest]).fetchall()
+        series = {}
+        for product_code, market_code, product, market, roc_date, avg_price in rows:
+            entry = series.setdefault((market_code, product_code), [product, market, []])
+            entry[0], entry[1] = product, market
+            entry[2].append((roc_date, avg_price))
+        return [tuple(entry) for entry in series.values()]
+
+try:
+    price_store = PriceHistoryStore(PRICE_DB_PATH)
+    price_store.ingest(df)
+    print("✅ 行情歷史資料庫已就緒。")
+except Exception as e:
+    print("❌ 無法開啟行情歷史資料庫:", e)
+    price_store = None
+
 # 產期資料（新的）
+CROP_CSV_PATH = "每月盛產農產品產地.csv"
+
+def clean_category(series):
+    """只對 category 的類別值做去空白，再以代碼對應回每一列（不逐列處理字串）"""
+    categories = series.cat.categories
+    cleaned = pd.Index(categories.astype(str)).str.strip().str.replace("　", "", regex=False)
+    # 空白欄位（NaN）一律對應到空字串
+    unique = pd.Index(pd.unique(cleaned.append(pd.Index([""]))))
+    mapping = unique.get_indexer(cleaned)
+    codes = series.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, mapping[codes], unique.get_loc(""))
+    return pd.Series(pd.Categorical.from_codes(codes, unique), index=series.index, name=series.name)
+
+def load_crop_frame(path: str):
+    """以 C 解析器讀入產期資料：文字欄位直接解析成 category、月份轉為整數，減少每個 worker 的記憶體"""
+    return prepare_crop_frame(pd.read_csv(path, encoding="utf-8-sig", on_bad_lines="skip", dtype="category"))
+
+def prepare_crop_frame(frame):
+    """整理 category 欄位：欄位名稱與類別值去空白，月份都是單一數字時轉成 int8"""
+    frame.columns = frame.columns.str.replace(r'\s+', '', regex=True).str.replace('\ufeff', '')
+    for col in frame.columns:
+        frame[col] = clean_category(frame[col])
+
+    if "月份" in frame.columns:
+        codes = frame["月份"].cat.codes.to_numpy()
+        months = pd.to_numeric(frame["月份"].cat.categories, errors="coerce").to_numpy()
+        # 月份若都是單一數字就存成整數，否則（例如 "1、2" 或空白）保留 category 交給索引解析；
+        # clean_category 一定會補上的 "" 類別沒有列使用時不影響判斷
+        if len(codes) and not np.isnan(months[np.unique(codes)]).any():
+            frame["月份"] = months[codes].astype("int8")
+    return frame
+
 try:
-    df_crop = pd.read_csv(
-        "每月盛產農產品產地.csv",
-        encoding="utf-8-sig",
-        on_bad_lines="skip",
-        engine="python"
-    )
-    df_crop.columns = df_crop.columns.str.replace(r'\s+', '', regex=True).str.replace('\ufeff', '')
-    df_crop = df_crop.applymap(lambda x: str(x).strip().replace("　", "") if isinstance(x, str) else x)
-    df_crop.fillna("", inplace=True)
+    df_crop = data_snapshot.get("df_crop", [CROP_CSV_PATH], lambda: load_crop_frame(CROP_CSV_PATH))
     print(f"✅ 成功讀入產期資料，共 {len(df_crop)} 筆。")
     print(df_crop[df_crop["品項"].astype(str).str.contains("你測不到的那個關鍵字", na=False)])
 except Exception as e:
@@ -120,378 +1072,1507 @@ chinese_to_num = {
     "七": 7, "八": 8, "九": 9, "十": 10, "十一": 11, "十二": 12
 }
 
-def convert_chinese_month_to_number(text: str):
-    """將中文月份轉換成阿拉伯數字（例如：十二月 → 12）"""
-    for ch, num in chinese_to_num.items():
-        if f"{ch}月" in text:
-            return num
-    return None
-
-def detect_region_and_type(user_text: str):
-    """偵測輸入文字中的地區與類型"""
-    regions, crop_type = [], None
-
-    # ✅ 改進：可同時偵測多個地區
-    for short, full_list in CITY_MAP.items():
-        if short in user_text:
-            regions.extend(full_list)
-
-    # ✅ 改進：支援別名轉換（果類→水果、蔬果→蔬菜等）
-    for t in TYPE_KEYWORDS + list(TYPE_ALIASES.keys()):
-        if t in user_text:
-            crop_type = TYPE_ALIASES.get(t, t)
-            break
-
-    return regions, crop_type
-
-
 def normalize_crop_name(name: str) -> str:
     """統一使用者輸入名稱格式"""
     return re.sub(r"[\s　]+", "", name)
 
-def match_crop_in_period_data(keyword: str):
-    """以品項名稱模糊搜尋產期資料"""
-    keyword = normalize_crop_name(keyword)
-    match_rule = df_crop[
-        df_crop["品項"].astype(str).str.contains(keyword, case=False, na=False)
-    ]
-    return match_rule
+# 常用俗名 → 產期資料中的品項名稱
+FRUIT_ALIASES = {
+    "釋迦": "番荔枝",
+    "棗子": "印度棗",
+    "梨子": "梨",
+    "芭樂": "番石榴",
+    "橘子": "柑",
+    "柳丁": "柳橙",
+    "火龍果": "紅龍果"
+}
 
 def expand_fruit_alias(keyword: str):
     """模糊關鍵字補全（同義詞轉換）"""
-    mapping = {
-        "釋迦": "番荔枝",
-        "棗子": "印度棗",
-        "梨子": "梨",
-        "芭樂": "番石榴",
-        "橘子": "柑",
-        "柳丁": "柳橙"
-    }
-    for k, v in mapping.items():
+    for k, v in FRUIT_ALIASES.items():
         if k in keyword:
             return v
     return keyword
-def sort_months_numerically(month_series):
-    """將月份依數值大小排序並轉回字串顯示"""
-    months = set()
-    for v in month_series:
-        # 只取出數字部分
-        nums = re.findall(r"\d+", str(v))
-        for n in nums:
-            try:
-                months.add(int(n))
-            except ValueError:
-                pass
-    return "、".join(str(m) for m in sorted(months))
-# ----------- 主處理邏輯 -----------
-required_cols = ["日期", "市場", "產品", "平均價(元/公斤)", "價格增減%"]
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    try:
-        user_id = event.source.user_id
-        user_text = event.message.text.strip()
-        messages = []
-
-        print(f"📩 收到使用者輸入：{user_text}")
-        # -------------------- #
-        # 品項查詢（列出所有不重複品項）
-        # -------------------- #
-        if user_text == "輔助工具":
-            try:
-                if df_crop.empty:
-                    reply_text = "⚠️ 尚未載入產期資料，請稍後再試。"
-                else:
-                    items = sorted(set(df_crop["品項"].dropna().astype(str).tolist()))
-                    reply_text = "很抱歉，輔助工具目前尚未開發完畢🙏\n你可以使用月份、蔬果種類、鄉鎮市等進行查詢功能\n📋所有可以查詢的品項如下：\n" + "、".join(items)
-            except Exception as e:
-                import traceback
-                print(traceback.format_exc())
-                reply_text = f"⚠️ 查詢品項時發生錯誤：{e}"
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
-
-        if user_text == "答題果園":
-            user_state[user_id] = "search"
-            msg = "很抱歉，答題果園目前尚未開發完畢🙏\n你可以使用月份、蔬果種類、鄉鎮市等進行查詢功能\n也可以使用即時資訊進行市場價查詢"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
-            return
-        if user_text == "本周水果報":
-            user_state[user_id] = "search"
-            msg = "很抱歉，本周水果報目前尚未開發完畢🙏\n你可以使用月份、蔬果種類、鄉鎮市等進行查詢功能\n也可以使用即時資訊進行市場價查詢"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
-            return
-        # -------------------- #
-        # 即時查詢入口
-        # -------------------- #
-        if user_text == "即時資訊":
-            user_state[user_id] = "search"
-            msg = "請輸入想查詢的水果名稱（例如：香蕉、芭樂、火龍果）\n點擊連結查看未來一周的氣象預報\nhttps://www.cwa.gov.tw/V8/C/W/week.html"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
-            return
-
-        # -------------------- #
-        # 即時查詢模式
-        # -------------------- #
-        if user_state.get(user_id) == "search":
-            user_state[user_id] = None
-            crop_name_input = re.sub(r"[\s　]+", "", user_text)
-            print(f"🔍 搜尋關鍵字：{crop_name_input}")
+# ----------- 錯字容錯比對 -----------
+
+class NGramMatcher:
+    """以字元 n-gram 反向索引快速找出候選詞，再用 difflib 只對少量候選計算相似度"""
+
+    def __init__(self, words, n: int = 2, max_candidates: int = 10):
+        """words 為 詞 → 優先度 的 dict（相似度相同時優先度高者勝出）"""
+        self.n = n
+        self.max_candidates = max_candidates
+        self.priority = {w: p for w, p in words.items() if w}
+        self.words = sorted(self.priority)
+        self.postings = {}
+        for i, word in enumerate(self.words):
+            for gram in self._grams(word):
+                self.postings.setdefault(gram, []).append(i)
+
+    def _grams(self, word: str):
+        # 中文詞多半只有 2～3 字，除了加上首尾標記的 n-gram 也收單字元
+        padded = f"^{word}$"
+        grams = set(word)
+        grams.update(padded[i:i + self.n] for i in range(len(padded) - self.n + 1))
+        return grams
+
+    def suggest(self, word: str, cutoff: float = 0.5, accept=None):
+        """回傳 (最相近的詞, 相似度)，找不到時回傳 (None, 0.0)；accept 可再過濾候選詞"""
+        counts = Counter()
+        for gram in self._grams(word):
+            counts.update(self.postings.get(gram, ()))
+        best, best_score = None, None
+        for i, shared in counts.most_common(self.max_candidates):
+            candidate = self.words[i]
+            if candidate == word or (accept is not None and not accept(candidate)):
+                continue
+            ratio = SequenceMatcher(None, word, candidate).ratio()
+            if ratio < cutoff:
+                continue
+            # 相似度相同時，依共用 n-gram 數、詞彙優先度決定
+            score = (ratio, shared, self.priority[candidate])
+            if best_score is None or score > best_score:
+                best, best_score = candidate, score
+        return (best, best_score[0]) if best is not None else (None, 0.0)
+
+def build_crop_vocabulary(data=None):
+    """收集兩份產期資料的品項、品種，行情資料的產品名稱，以及同義詞表（回傳 詞 → 優先度）"""
+    data = data or crop_data
+    words = {}
+    if not data.empty:
+        # 品種拆出來的片段優先度最低；台農57、13 號之類的編號不是品名，不收
+        for variety in data.table["品種"].cat.categories.astype(str):
+            words.update((w, 1) for w in re.split(r"[、，,：:()（）及\s]+", variety)
+                         if len(w) >= 2 and not re.search(r"[0-9A-Za-z]", w))
+    if not df.empty:
+        for product in df["產品_name_only"].astype(str).unique():
+            # 去掉 A1、G39 之類的產品代碼
+            words.update((w, 2) for w in product.split() if len(w) >= 2 and not re.match(r"^[A-Z]?\d+$", w))
+    words.update((w, 3) for w in data.item_names if w)
+    words.update((w, 3) for w in FRUIT_ALIASES)
+    return words
+
+def rebuild_crop_matcher(data=None):
+    """資料重新載入後重建比對索引"""
+    global crop_matcher
+    crop_matcher = NGramMatcher(build_crop_vocabulary(data))
+
+# 相似度達 SUGGEST_MIN_RATIO 只提示「您是不是要找」；至少 AUTOCORRECT_MIN_LENGTH 個字
+# 且相似度達 AUTOCORRECT_MIN_RATIO（例如 3 個字只錯 1 個）才直接改查建議的品項。
+# 兩個字的詞只要共用一個字相似度就有 0.5（桃子／柿子、水果／芒果），
+# 因此 SHORT_INPUT_LENGTH 個字以內的輸入改用 SHORT_SUGGEST_MIN_RATIO，也不會自動改查
+SUGGEST_MIN_RATIO = 0.5
+SHORT_INPUT_LENGTH = 2
+SHORT_SUGGEST_MIN_RATIO = 0.6
+AUTOCORRECT_MIN_LENGTH = 3
+AUTOCORRECT_MIN_RATIO = 0.66
+
+def suggest_cutoff(keyword: str):
+    return SHORT_SUGGEST_MIN_RATIO if len(keyword) <= SHORT_INPUT_LENGTH else SUGGEST_MIN_RATIO
+
+@timed("query")
+def suggest_crop_name(keyword: str, accept=None):
+    """錯字容錯：回傳「您是不是要找」的建議詞（與輸入相同時不建議）；accept 可再過濾候選詞"""
+    if len(keyword) < 2:
+        return None
+    return crop_matcher.suggest(keyword, suggest_cutoff(keyword), accept=accept)[0]
+
+def has_crop_seasons(word: str, data=None):
+    return bool(lookup_crop_seasons(word, expand_fruit_alias(word), data=data))
+
+@timed("query")
+def correct_crop_name(keyword: str, data=None):
+    """產期查詢的錯字容錯：只考慮查得到產期段落的詞，回傳 (建議詞, 是否直接改查)"""
+    if len(keyword) < 2:
+        return None, False
+    suggestion, ratio = crop_matcher.suggest(keyword, suggest_cutoff(keyword),
+                                             accept=lambda word: has_crop_seasons(word, data))
+    confident = len(keyword) >= AUTOCORRECT_MIN_LENGTH and ratio >= AUTOCORRECT_MIN_RATIO
+    return suggestion, suggestion is not None and confident
+
+
+# ----------- 產期彙總 -----------
+# 啟動時先把 (類型, 品項, 品種, 縣市) → 合併後月份 算好並排好版，
+# 作物查詢只需找出符合的品項、取出現成段落，不必每次 groupby
+
+CROP_SEASON_KEYS = ["類型", "品項", "品種", "縣市"]
+
+def render_season_block(row):
+    """單一 (類型, 品項, 品種, 縣市) 組合的產期段落"""
+    parts = []
+    for field in CROP_SEASON_KEYS + ["月份"]:
+        if field in row and str(row[field]).strip():
+            parts.append(f"{field}：{row[field]}")
+    return "\n".join(parts) + "\n---------------------\n"
+
+def build_crop_seasons(table):
+    """由合併後的產期表（含東部資料）建立 {"blocks": [段落...], "by_item": {品項: [段落位置...]}}
+
+    同一 (類型, 品項, 品種, 縣市) 的各產地月份遮罩取聯集；段落依欄位值排序，空白值排在最後
+    （與原本對 category 欄位 groupby 的順序相同）。
+    """
+    seasons = {"blocks": [], "by_item": {}}
+    if table.empty:
+        return seasons
+
+    masks = {}
+    for record in table[CROP_SEASON_KEYS + ["mask"]].itertuples(index=False, name=None):
+        key = tuple(str(v) for v in record[:-1])
+        masks[key] = masks.get(key, 0) | int(record[-1])
+    for position, key in enumerate(sorted(masks, key=lambda k: [(v == "", v) for v in k])):
+        row = dict(zip(CROP_SEASON_KEYS, key))
+        row["月份"] = "、".join(str(m) for m in mask_to_months(masks[key]))
+        seasons["blocks"].append(render_season_block(row))
+        seasons["by_item"].setdefault(row["品項"], []).append(position)
+    return seasons
+
+# 作物查詢字來自使用者輸入，記憶的結果以 LRU 限制數量
+CROP_SEASON_MEMO_SIZE = int(os.environ.get("CROP_SEASON_MEMO_SIZE", "1024"))
+
+@lru_cache(maxsize=CROP_SEASON_MEMO_SIZE)
+def crop_season_positions(data, keyword: str):
+    """data.seasons 中品項名稱包含 keyword 的段落位置（子字串比對，不分大小寫）"""
+    needle = keyword.lower()
+    return tuple(sorted(p for item, item_positions in data.seasons["by_item"].items()
+                        if needle in item.lower() for p in item_positions))
+
+def lookup_crop_seasons(*keywords, data=None):
+    """以品項子字串取出排好版的產期段落（多個關鍵字時取聯集，依段落順序排列）"""
+    data = data or crop_data
+    positions = set()
+    for keyword in keywords:
+        positions.update(crop_season_positions(data, normalize_crop_name(keyword)))
+    return [data.seasons["blocks"][p] for p in sorted(positions)]
+
+
+# ----------- 產期月份遮罩 -----------
+# 兩份產期資料的月份欄位都轉成 12 位元遮罩（第 m-1 位元代表 m 月），
+# 「某月盛產」「X、Y 月都盛產」「當季」都只是對整數陣列做位元運算
+
+EAST_SEASON_CSV_PATH = "東部地區時令水果產期資訊.csv"
+EAST_SEASON_COUNTY = "台東縣"
+SEASON_FIELDS = ["類型", "品項", "品種", "縣市", "鄉鎮"]
+SEASON_RANGE_PATTERN = re.compile(r"(\d{1,2})\s*月?\s*(?:[~～\-－至到]\s*(?:翌年)?\s*(\d{1,2})\s*月?)?")
+
+def parse_month_numbers(value):
+    """取出月份欄位中的所有月份數字（例如："1、2" → [1, 2]）"""
+    months = []
+    for n in re.findall(r"\d+", str(value)):
+        m = int(n)
+        if 1 <= m <= 12:
+            months.append(m)
+    return months
+
+def months_to_mask(months):
+    mask = 0
+    for m in months:
+        if 1 <= m <= 12:
+            mask |= 1 << (m - 1)
+    return mask
+
+def mask_to_months(mask: int):
+    return [m for m in range(1, 13) if mask >> (m - 1) & 1]
+
+def parse_month_expression(value):
+    """解析月份文字成月份列表（依出現順序），支援「1、2」「12~4月」「7月~翌年2月」「1~3月、5~9月」"""
+    months = []
+    for start, end in SEASON_RANGE_PATTERN.findall(str(value)):
+        start = int(start)
+        end = int(end) if end else start
+        if not (1 <= start <= 12 and 1 <= end <= 12):
+            continue
+        # 結束月份小於開始月份代表跨年（例如 11~2 月）
+        span = end - start if end >= start else end + 12 - start
+        months.extend((start - 1 + i) % 12 + 1 for i in range(span + 1))
+    return list(dict.fromkeys(months))
+
+def parse_season_mask(value):
+    """解析產期文字成月份遮罩"""
+    return months_to_mask(parse_month_expression(value))
+
+def load_east_season_frame(path: str):
+    """讀入東部地區時令水果產期資訊，「水蜜桃(台農甜蜜桃)」拆成品項與品種"""
+    frame = pd.read_csv(path, encoding="utf-8-sig", dtype=str).fillna("")
+    frame.columns = frame.columns.str.strip()
+    names = frame["品項"].str.strip().str.extract(r"^(?P<品項>[^()（）]+)[(（]?(?P<品種>[^()（）]*)[)）]?$")
+    return pd.DataFrame({
+        "類型": "水果",
+        "品項": names["品項"].str.strip(),
+        "品種": names["品種"].fillna("").str.strip(),
+        "縣市": EAST_SEASON_COUNTY,
+        "鄉鎮": frame["主要產地"].str.strip(),
+        "mask": frame["主要產期"].map(parse_season_mask).astype("uint16"),
+    })
+
+def build_season_table(crop_frame, east_frame):
+    """合併兩份資料成 (品項, 品種, 產地) → 月份遮罩 的表格
+
+    另外記錄每個組合在各月份第一次出現的列位置（order），
+    查詢單一月份時依此排序，品項順序就與原本逐列篩選的結果相同。
+    """
+    parts, orders = [], []
+    if not crop_frame.empty:
+        keys = [f for f in SEASON_FIELDS if f in crop_frame.columns]
+        gid = crop_frame.groupby(keys, observed=True, sort=False).ngroup().to_numpy()
+        n_groups = gid.max() + 1 if len(gid) else 0
+
+        # 展開成 (列位置, 月份) 配對：整數月份直接使用，其餘（例如 "1、2"）逐一解析類別值
+        if crop_frame["月份"].dtype.kind in "iu":
+            rows, months = np.arange(len(crop_frame)), crop_frame["月份"].to_numpy().astype(int)
+        else:
+            values = crop_frame["月份"].astype(str).to_numpy()
+            pairs = [(i, m) for i, v in enumerate(values) for m in parse_month_numbers(v)]
+            rows = np.array([p[0] for p in pairs], dtype=int)
+            months = np.array([p[1] for p in pairs], dtype=int)
+        valid = (months >= 1) & (months <= 12)
+        rows, months = rows[valid], months[valid]
+
+        masks = np.zeros(n_groups, dtype="uint16")
+        np.bitwise_or.at(masks, gid[rows], (1 << (months - 1)).astype("uint16"))
+        order = np.full((n_groups, 12), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(order, (gid[rows], months - 1), rows)
+
+        first_rows = pd.Series(np.arange(len(crop_frame))).groupby(gid).min().to_numpy()
+        part = crop_frame.iloc[first_rows][keys].astype(str).reset_index(drop=True)
+        part["mask"] = masks
+        parts.append(part)
+        orders.append(order)
+        offset = len(crop_frame)
+    else:
+        offset = 0
+
+    if not east_frame.empty:
+        parts.append(east_frame.reset_index(drop=True))
+        # 東部資料排在原資料之後
+        orders.append(np.repeat(offset + np.arange(len(east_frame))[:, None], 12, axis=1))
+
+    if not parts:
+        return pd.DataFrame(columns=SEASON_FIELDS + ["mask"]), np.empty((0, 12), dtype=np.int64)
+    table = pd.concat(parts, ignore_index=True)
+    for field in SEASON_FIELDS:
+        table[field] = table[field].fillna("").astype("category")
+    table["mask"] = table["mask"].astype("uint16")
+    return table, np.vstack(orders)
+
+class CropData:
+    """一份產期資料與其衍生索引（產期表、月份遮罩、品項名稱、彙總段落、作物名稱 regex），建立後不再修改
+
+    上游更新時建立新的一份，以單一指定替換全域的 crop_data；處理訊息時先取一次區域參考，
+    同一個請求用到的表格與索引一定來自同一份資料。
+    """
+
+    __slots__ = ("frame", "table", "order", "masks", "item_names", "type_names", "seasons", "crop_pattern",
+                 "_filters")
+
+    def __init__(self, frame, table, order, seasons):
+        item_names = table["品項"].astype(str).to_numpy()
+        values = {
+            "frame": frame,
+            "table": table,
+            "order": order,
+            "masks": table["mask"].to_numpy(dtype="uint16"),
+            "item_names": item_names,
+            "type_names": table["類型"].astype(str).to_numpy(),
+            "seasons": seasons,
+            "crop_pattern": build_crop_pattern(item_names),
+            "_filters": {},
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CropData 建立後不可修改，請建立新的一份再替換 crop_data")
+
+    @property
+    def empty(self):
+        return self.table.empty
+
+    def season_filter(self, field: str, keyword: str):
+        """以子字串比對 category 欄位：只比對類別值，再以代碼展開成布林陣列（結果會記憶起來）"""
+        memo_key = (field, keyword)
+        if memo_key not in self._filters:
+            column = self.table[field]
+            categories = column.cat.categories.astype(str)
+            hit = np.append(categories.str.contains(keyword, case=False, regex=False), False)
+            self._filters[memo_key] = hit[column.cat.codes.to_numpy()]
+        return self._filters[memo_key]
+
+@timed("query")
+def season_positions(months, crop_type=None, region=None, data=None):
+    """所有指定月份都在產期內的組合位置（依第一個月份的原始順序排列）"""
+    data = data or crop_data
+    if data.empty or not months or not all(1 <= m <= 12 for m in months):
+        return np.empty(0, dtype=np.int64)
+    required = np.uint16(months_to_mask(months))
+    hit = (data.masks & required) == required
+    if crop_type:
+        hit &= data.season_filter("類型", crop_type)
+    if region:
+        hit &= data.season_filter("縣市", region)
+    positions = np.flatnonzero(hit)
+    return positions[np.argsort(data.order[positions, months[0] - 1], kind="stable")]
+
+@timed("query")
+def season_positions_in_region(region: str, crop_type=None, data=None):
+    """某縣市（可再限定類型）全年的產期組合位置，依原始資料順序排列"""
+    data = data or crop_data
+    hit = data.season_filter("縣市", region)
+    if crop_type:
+        hit = hit & data.season_filter("類型", crop_type)
+    return np.flatnonzero(hit)
+
+def season_items(positions, data=None):
+    """依序列出不重複的品項名稱"""
+    data = data or crop_data
+    return list(dict.fromkeys(data.item_names[positions].tolist()))
+
+def current_month():
+    return time.localtime().tm_mon
 
-            try:
-                if df.empty:
-                    raise ValueError("即時行情資料尚未載入")
-
-                if not all(col in df.columns for col in required_cols):
-                    raise KeyError(f"欄位名稱不符，目前 CSV 欄位：{df.columns.tolist()}")
-
-                results = df[df["產品_name_only"].str.contains(crop_name_input, case=False, na=False)]
-                if results.empty:
-                    results = df[df["產品_clean"].str.contains(crop_name_input, case=False, na=False)]
-
-                if not results.empty:
-                    latest_date = results["日期"].max()
-                    recent_data = results[results["日期"] == latest_date]
-
-                    reply_text = f"📅 最新交易日期：{latest_date}\n🍎 查詢關鍵字：{crop_name_input}\n------------------------\n"
-                    for _, row in recent_data.iterrows():
-                        try:
-                            change = float(row['價格增減%'])
-                        except ValueError:
-                            change = 0
-                        arrow = "📈" if change > 0 else "📉" if change < 0 else "💲"
-
-                        reply_text += (
-                            f"🥭 品項：{row['產品']}\n"
-                            f"🏬 市場：{row['市場']}\n"
-                            f"💰 平均價：{row['平均價(元/公斤)']} 元/公斤\n"
-                            f"{arrow} 價格漲幅(%)：{row['價格增減%']} %\n"
-                            "------------------------\n"
-                        )
-                else:
-                    reply_text = f"查無「{crop_name_input}」的市場價格資料。"
+try:
+    df_east_season = data_snapshot.get("df_east_season", [EAST_SEASON_CSV_PATH],
+                                       lambda: load_east_season_frame(EAST_SEASON_CSV_PATH))
+    print(f"✅ 成功讀入東部時令水果產期資料，共 {len(df_east_season)} 筆。")
+except Exception as e:
+    print("❌ 無法讀入東部時令水果產期資料:", e)
+    df_east_season = pd.DataFrame()
+
+
+# ----------- 意圖路由 -----------
+# 每則訊息依序以幾個預先編譯好的 regex 與 in 判斷取出月份、地區與類型；
+# 作物名稱的 regex 隨產期資料一起建立（見 CropData），只有真的需要作物名稱時才掃描
+
+MENU_INTENTS = {"輔助工具": "tools", "答題果園": "quiz", "本周水果報": "weekly", "即時資訊": "search_entry",
+                "下一頁": "next_page"}
+
+# 「當季」「現在」之類的詞代表目前月份
+NOW_KEYWORDS = ["現在", "當季", "當令", "本月", "這個月"]
+# 第一組：「12月」「7、8月」「7到9月」之類的阿拉伯數字月份（列舉與區間交給 parse_month_expression 展開）；
+# 第二組：中文月份，「十一月」「十二月」要比「一月」「二月」先比對
+MONTH_PATTERN = re.compile(r"(\d{1,2}(?:\s*[、，,和與及跟~～\-－至到]\s*\d{1,2})*)\s*月|(十[一二]?|[一二三四五六七八九])月")
+TYPE_PRIORITY = TYPE_KEYWORDS + list(TYPE_ALIASES.keys())
+# 縣市簡稱編成一個 regex（簡稱彼此不會重疊），一次找出訊息中的所有縣市
+CITY_PATTERN = re.compile("|".join(CITY_MAP))
+CITY_ORDER = {short: i for i, short in enumerate(CITY_MAP)}
+
+Route = namedtuple("Route", ["intent", "month", "months", "regions", "crop_type", "crops", "history"])
+# 選單字串的 Route 固定不變，預先建好
+MENU_ROUTES = {text: Route(intent, None, [], [], None, [], None) for text, intent in MENU_INTENTS.items()}
+
+def build_crop_pattern(item_names):
+    """已知品項與俗名編成一個 regex（長的詞排前面，同一位置取最長的品項）
+
+    與縣市簡稱、類型或中文月份相同的詞不當作作物名稱。
+    """
+    router_words = set(CITY_MAP) | set(TYPE_PRIORITY) | {f"{ch}月" for ch in chinese_to_num} | set(NOW_KEYWORDS)
+    words = [w for w in dict.fromkeys(list(item_names) + list(FRUIT_ALIASES)) if w and w not in router_words]
+    if not words:
+        return re.compile(r"(?!)")
+    return re.compile("|".join(re.escape(w) for w in sorted(words, key=len, reverse=True)))
+
+def extract_months(user_text: str):
+    """取出訊息中的月份（阿拉伯數字優先，其次依出現順序排列中文月份）"""
+    months, chinese = [], []
+    if "月" not in user_text:
+        return months
+    for expr, ch in MONTH_PATTERN.findall(user_text):
+        if ch:
+            chinese.append(chinese_to_num[ch])
+        elif expr.isdecimal():
+            # 單一數字與原本的 r"(\d{1,2})\s*月" 相同，不檢查範圍（超出範圍時回覆查無資料）
+            if int(expr):
+                months.append(int(expr))
+        else:
+            months.extend(parse_month_expression(expr))
+    months += chinese
+    return list(dict.fromkeys(months)) if len(months) > 1 else months
+
+def extract_crops(user_text: str, data=None):
+    """取出訊息中的已知品項（由左到右、互不重疊，同一位置取最長者）"""
+    return (data or crop_data).crop_pattern.findall(user_text)
+
+@timed("route")
+def route_message(user_text: str, data=None):
+    """解析訊息，回傳 Route（intent 依 選單 > 歷史行情 > 月份 > 地區 > 作物 決定）"""
+    route = MENU_ROUTES.get(user_text)
+    if route:
+        return route
+
+    # 依意圖的優先順序逐一判斷，只取出該意圖會用到的欄位
+    history = parse_history_query(user_text) if "天" in user_text else None
+    if history:
+        return Route("history", None, [], [], None, [], history)
+
+    months = extract_months(user_text)
+    regions, crop_type, crops = [], None, []
+    if not months:
+        cities = CITY_PATTERN.findall(user_text)
+        # 地區依 CITY_MAP 的順序排列，與快取鍵保持一致
+        if cities:
+            regions = [full for short in sorted(set(cities), key=CITY_ORDER.get) for full in CITY_MAP[short]]
+        else:
+            crops = extract_crops(user_text, data)
+            # 只有「當季」而沒有指定作物時，視為查詢目前月份
+            if not crops and any(w in user_text for w in NOW_KEYWORDS):
+                months = [current_month()]
+
+    if months or regions:
+        # 類型依 TYPE_PRIORITY 的順序取第一個出現的（類型只有幾個，逐一 in 比 regex 快）
+        for t in TYPE_PRIORITY:
+            if t in user_text:
+                crop_type = TYPE_ALIASES.get(t, t)
+                break
+
+    month = months[0] if months else None
+    intent = "month" if month else "region" if regions else "crop"
+    return Route(intent, month, months, regions, crop_type, crops, history)
+
+def build_crop_data(frame):
+    """由產期資料（加上東部資料）建立新的一份 CropData"""
+    table, order = build_season_table(frame, df_east_season)
+    return CropData(frame, table, order, build_crop_seasons(table))
+
+def assemble_crop_data():
+    """啟動時由快照中的各部分組成第一份 CropData（只重建來源有變動的部分）"""
+    sources = [CROP_CSV_PATH, EAST_SEASON_CSV_PATH]
+    table, order = data_snapshot.get("season_table", sources, lambda: build_season_table(df_crop, df_east_season))
+    seasons = data_snapshot.get("crop_seasons", sources, lambda: build_crop_seasons(table))
+    return CropData(df_crop, table, order, seasons)
+
+# 之後一律透過 crop_data 取用產期資料；上游更新時整份替換（見 publish_crop_frame）
+crop_data = assemble_crop_data()
+# 快照只存詞彙 dict：pickle 自訂類別會記下模組名稱（python app.py 是 __main__，gunicorn 是 app），
+# 兩種啟動方式便無法共用同一份快照
+crop_matcher = NGramMatcher(data_snapshot.get("crop_vocabulary", [PRICE_CSV_PATH, CROP_CSV_PATH, EAST_SEASON_CSV_PATH],
+                                              build_crop_vocabulary))
+# ----------- 回覆文字快取 -----------
+# 月份、地區、作物與品項清單的回覆以「解析後的查詢意圖」為鍵快取，資料重新載入時清空
+
+REPLY_CACHE_SIZE = int(os.environ.get("REPLY_CACHE_SIZE", "256"))
+
+reply_cache = LRUCache(REPLY_CACHE_SIZE)
+_MISSING = object()
+
+def cached_reply(key, build):
+    """查詢快取，未命中時呼叫 build() 產生回覆並存入（發生例外時不快取）"""
+    value = reply_cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = build()
+        reply_cache.put(key, value)
+    return value
+
+def invalidate_reply_cache():
+    """產期/行情資料重新載入後呼叫，清空所有已產生的回覆"""
+    reply_cache.clear()
+
+# ----------- 回覆文字產生 -----------
+
+def render_grouped_items(types, items, limit=None):
+    """依類型分段列出品項（預設四種類型在前，其餘類型依名稱排序在後）"""
+    groups = {}
+    for gtype, item in zip(types, items):
+        groups.setdefault(str(gtype), {})[str(item)] = None
+    other_types = sorted(t for t in groups if t not in TYPE_KEYWORDS)
+    text = ""
+    for gtype in [t for t in TYPE_KEYWORDS if t in groups] + other_types:
+        items = list(groups[gtype])
+        if limit and len(items) > limit:
+            items = items[:limit]
+        joined_items = "、".join(items)
+        text += f"【{gtype}】\n{joined_items}\n---------------------\n"
+    return text
+
+@timed("render")
+def render_item_list(data=None):
+    """列出所有不重複品項"""
+    items = sorted(set((data or crop_data).item_names.tolist()) - {""})
+    return "很抱歉，輔助工具目前尚未開發完畢🙏\n你可以使用月份、蔬果種類、鄉鎮市等進行查詢功能\n📋所有可以查詢的品項如下：\n" + "、".join(items)
+
+@timed("render")
+def render_month_reply(months, crop_type, data=None):
+    """月份查詢的回覆文字（多個月份時列出每個月份都盛產的品項）"""
+    data = data or crop_data
+    # 以月份遮罩做位元運算篩選，並納入東部地區時令水果
+    positions = season_positions(list(months), crop_type=crop_type, data=data)
+    month_label = "、".join(str(m) for m in months)
+    both = "都盛產" if len(months) > 1 else ""
+
+    if not len(positions):
+        return f"❌ 查無 {month_label} 月{both}的{crop_type or '農產品'}資料。"
+
+    if crop_type:
+        # ✅ 有指定類型，直接列出品項
+        items = season_items(positions, data)
+        if len(items) > 30:
+            items = items[:30]
+        joined_items = "、".join(items)
+        return f"{month_label}月{both}的{crop_type}有：{joined_items}。"
+
+    # ✅ 沒指定類型 → 分類分段顯示
+    reply_text = f"🍀 {month_label}月{'都' if both else ''}盛產的農產品如下：\n=====================\n"
+    return reply_text + render_grouped_items(data.type_names[positions], data.item_names[positions], limit=30)
+
+@timed("render")
+def render_region_reply(regions, crop_type, data=None):
+    """地區查詢的回覆文字"""
+    data = data or crop_data
+    if data.empty:
+        raise ValueError("產期資料尚未載入")
+
+    # ✅ 可多縣市查詢；若有明確類型，僅顯示該類型（與月份查詢共用產期表，含東部時令水果）
+    positions = np.concatenate([season_positions_in_region(region, crop_type, data) for region in regions])
+
+    shown_region = "、".join([r.replace("臺", "台") for r in regions])
+    if not len(positions):
+        return f"❌ 查無 {shown_region} 的{crop_type or '農產品'}資料。"
+
+    # ✅ 若有指定 crop_type，維持舊格式
+    if crop_type:
+        joined_items = "、".join(season_items(positions, data))
+        return f"{shown_region}盛產的{crop_type}有：{joined_items}。"
+
+    # ✅ 沒有指定類型 → 依類型分組顯示
+    reply_text = f"🍀 {shown_region}盛產項目如下：\n"
+    reply_text += "=====================\n"
+    return reply_text + render_grouped_items(data.type_names[positions], data.item_names[positions])
+
+@timed("render")
+def render_crop_section(crop_input: str, data=None):
+    """單一作物的產期段落，回傳 (文字, 是否查到資料, 只提示未改查的建議詞)"""
+    data = data or crop_data
+    alias = expand_fruit_alias(crop_input)
+    # 俗名與正式品項都有資料時一起列出（例如「釋迦」：東部資料的釋迦與產期資料的番荔枝）
+    blocks = lookup_crop_seasons(crop_input, alias, data=data)
+
+    text = f"🍀 查詢作物：{crop_input}\n=====================\n"
+    if not blocks:
+        # 錯字容錯：相似度夠高才直接改查建議的品項，否則只提示
+        suggestion, confident = correct_crop_name(crop_input, data)
+        if not suggestion:
+            return f"❌ 查無 {crop_input} 的產期資料。\n---------------------\n", False, None
+        if not confident:
+            return (f"❌ 查無 {crop_input} 的產期資料，您是不是要找「{suggestion}」？\n---------------------\n",
+                    False, suggestion)
+
+        blocks = lookup_crop_seasons(suggestion, expand_fruit_alias(suggestion), data=data)
+        text = f"🍀 查詢作物：{suggestion}（您輸入的是「{crop_input}」）\n=====================\n"
+
+    # ✅ 相同項目的不同月份已在載入時合併（見 build_crop_seasons）
+    return text + "".join(blocks), True, None
+
+# ----------- 行情歷史查詢 -----------
+# 範例：「芭樂近7天均價」、「香蕉台北二 30天走勢」
+
+HISTORY_PATTERN = re.compile(r"^(?P<name>.+?)\s*近?\s*(?P<days>\d{1,3})\s*天\s*(?P<kind>均價|平均價?|走勢|趨勢|漲跌)?$")
+HISTORY_MAX_DAYS = 365
+
+def parse_history_query(user_text: str):
+    """解析歷史行情查詢，回傳 (品名, 天數, 市場, 是否為走勢)，不是歷史查詢時回傳 None"""
+    if price_store is None:
+        return None
+    m = HISTORY_PATTERN.match(user_text)
+    if not m:
+        return None
+    name = normalize_crop_name(m.group("name"))
+    days = min(max(int(m.group("days")), 1), HISTORY_MAX_DAYS)
+    market = None
+    for market_name in price_store.markets():
+        if market_name and market_name in name and market_name != name:
+            market = market_name
+            name = name.replace(market_name, "")
+            break
+    is_trend = m.group("kind") in ("走勢", "趨勢", "漲跌")
+    return name, days, market, is_trend
+
+def find_price_codes(name: str):
+    """以品名找產品代碼，找不到時改用同義詞"""
+    codes = price_store.find_codes(name)
+    if not codes:
+        alias = expand_fruit_alias(name)
+        if alias != name:
+            codes = price_store.find_codes(alias)
+    return codes
+
+@timed("render")
+def render_price_history(name: str, days: int, market, is_trend: bool):
+    """N 天均價 / 走勢的回覆文字"""
+    codes = find_price_codes(name)
+    title = f"{name}{f'（{market}）' if market else ''} 近{days}天{'走勢' if is_trend else '均價'}"
+    if not codes:
+        return f"查無「{name}」的市場價格資料。"
+
+    reply_text = f"📊 {title}\n------------------------\n"
+    if not is_trend:
+        rows = price_store.average(codes, days, market)
+        if not rows:
+            return f"查無「{name}」在{market}的市場價格資料。"
+        for product, market_label, avg_price, n_days, first_date, last_date in rows:
+            reply_text += (
+                f"🥭 品項：{product}\n"
+                f"🏬 市場：{market_label}\n"
+                f"💰 平均價：{avg_price:.1f} 元/公斤\n"
+                f"📅 {first_date}～{last_date}（{n_days} 個交易日）\n"
+                "------------------------\n"
+            )
+        return reply_text
+
+    series_list = price_store.trend(codes, days, market)
+    if not series_list:
+        return f"查無「{name}」在{market}的市場價格資料。"
+    for product, market_label, series in series_list:
+        first_date, first_price = series[0]
+        last_date, last_price = series[-1]
+        if first_price and last_price is not None and len(series) > 1:
+            change = (last_price - first_price) / first_price * 100
+            arrow = "📈" if change > 0 else "📉" if change < 0 else "💲"
+            change_text = f"{arrow} 期間漲幅：{change:+.1f} %"
+        else:
+            change_text = "💲 期間內只有一個交易日"
+        daily = "、".join(f"{d[4:]} {p}" for d, p in series)
+        reply_text += (
+            f"🥭 品項：{product}\n"
+            f"🏬 市場：{market_label}\n"
+            f"📅 {first_date} {first_price} → {last_date} {last_price} 元/公斤\n"
+            f"{change_text}\n"
+            f"🗓️ 每日均價：{daily}\n"
+            "------------------------\n"
+        )
+    return reply_text
+
+def format_change(value):
+    """價格增減% 顯示用（整數不顯示小數點）"""
+    if value is None:
+        return "-"
+    return f"{value:g}"
+
+@timed("query")
+def latest_price_rows(prices, keyword: str):
+    """最新交易日的行情，回傳 (日期, [(產品, 市場, 平均價, 價格增減%), ...])"""
+    if price_store is not None:
+        # ✅ 以歷史資料庫的索引查最新交易日，不掃描整份 DataFrame
+        latest_date, rows = price_store.latest(find_price_codes(keyword))
+        return latest_date, [(product, market, avg_price, format_change(change))
+                             for _, product, market, avg_price, change in rows]
+
+    results = prices[prices["產品_name_only"].str.contains(keyword, case=False, na=False)]
+    if results.empty:
+        results = prices[prices["產品_clean"].str.contains(keyword, case=False, na=False)]
+    if results.empty:
+        alias = expand_fruit_alias(keyword)
+        if alias != keyword:
+            return latest_price_rows(prices, alias)
+        return None, []
+
+    latest_date = results["日期"].max()
+    recent_data = results[results["日期"] == latest_date]
+    return latest_date, [(row['產品'], row['市場'], row['平均價(元/公斤)'], row['價格增減%'])
+                         for _, row in recent_data.iterrows()]
+
+# ----------- 本周水果報 -----------
+# 摘要只在資料更新或換月時重新計算一次，使用者查詢與群發都共用同一份文字
+
+WEEKLY_TOP_N = 5
+
+def weekly_digest_key():
+    """本周水果報的快取鍵（當令水果依目前月份而定）"""
+    return ("weekly", current_month())
+
+@timed("render")
+def render_weekly_digest():
+    """本周水果報：價格漲跌幅、交易量變化最大的品項，以及本月當令水果"""
+    prices = df  # 取用當下的快照
+    month_num = current_month()
+    if prices.empty:
+        raise ValueError("即時行情資料尚未載入")
+
+    latest_date = prices["日期"].max()
+    latest = prices[prices["日期"] == latest_date].copy()
+    latest["price_change"] = pd.to_numeric(latest["價格增減%"], errors="coerce")
+    latest["volume_change"] = pd.to_numeric(latest["增減%"], errors="coerce")
+    latest["volume"] = pd.to_numeric(latest["交易量(公斤)"].astype(str).str.replace(",", ""), errors="coerce")
+
+    def label(row):
+        name = re.sub(r"\s+", " ", split_code(row["產品"])[1])
+        return f"{name}（{split_code(row['市場'])[1]}）"
+
+    reply_text = f"📰 本周水果報（{latest_date}）\n=====================\n"
+
+    movers = latest.dropna(subset=["price_change"])
+    reply_text += "📈 漲幅最大\n"
+    for i, (_, row) in enumerate(movers.nlargest(WEEKLY_TOP_N, "price_change").iterrows(), 1):
+        reply_text += f"{i}. {label(row)} {row['平均價(元/公斤)']} 元/公斤 {row['price_change']:+g} %\n"
+    reply_text += "---------------------\n📉 跌幅最大\n"
+    for i, (_, row) in enumerate(movers.nsmallest(WEEKLY_TOP_N, "price_change").iterrows(), 1):
+        reply_text += f"{i}. {label(row)} {row['平均價(元/公斤)']} 元/公斤 {row['price_change']:+g} %\n"
+
+    volumes = latest.dropna(subset=["volume_change"])
+    volumes = volumes.loc[volumes["volume_change"].abs().sort_values(ascending=False).index[:WEEKLY_TOP_N]]
+    reply_text += "---------------------\n📦 交易量變化最大\n"
+    for i, (_, row) in enumerate(volumes.iterrows(), 1):
+        volume = f"{row['volume']:,.0f} 公斤 " if pd.notna(row["volume"]) else ""
+        reply_text += f"{i}. {label(row)} {volume}{row['volume_change']:+g} %\n"
+
+    items = season_items(season_positions([month_num], crop_type="水果"))[:30]
+    reply_text += f"---------------------\n🍀 {month_num}月當令水果\n{'、'.join(items) or '（無資料）'}\n"
+    return reply_text
+
+def send_reply(reply_token, messages):
+    """送出回覆（計入 reply 階段耗時）"""
+    with span("reply"):
+        line_bot_api.reply_message(reply_token, messages)
+
+# ----------- 分頁回覆 -----------
+# 長回覆依段落（分隔線、頓號）切成多則訊息，每次回覆最多送出 REPLY_MAX_MESSAGES 則；
+# 剩下的頁面連同頁碼存在使用者游標裡，輸入「下一頁」時直接取出，不必重新查詢
+
+PAGE_MAX_CHARS = int(os.environ.get("PAGE_MAX_CHARS", "1900"))
+# LINE 每次回覆最多 5 則訊息
+REPLY_MAX_MESSAGES = min(int(os.environ.get("REPLY_MAX_MESSAGES", "3")), 5)
+NEXT_PAGE_KEYWORD = "下一頁"
+PAGE_SEPARATOR_PATTERN = re.compile(r"^[-=]{5,}$")
+# 頁尾提示預留的字數
+PAGE_FOOTER_RESERVE = 40
+
+def split_long_entry(entry: str, max_chars: int):
+    """單一段落超過上限時，優先在頓號、換行處切開，實在太長才硬切"""
+    pieces, current = [], ""
+    for token in re.split(r"(?<=[、\n])", entry):
+        # 切點剛好落在分隔線上時省略分隔線，下一則不會只剩一條線
+        if len(current) + len(token) > max_chars and PAGE_SEPARATOR_PATTERN.match(token.strip()):
+            if current:
+                pieces.append(current)
+            current = ""
+            continue
+        while len(token) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(token[:max_chars])
+            token = token[max_chars:]
+        if len(current) + len(token) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += token
+    if current:
+        pieces.append(current)
+    return pieces
+
+def paginate_text(text: str, max_chars: int = PAGE_MAX_CHARS):
+    """把回覆切成多則訊息，切點落在段落（分隔線）之間，回傳 tuple"""
+    limit = max(max_chars - PAGE_FOOTER_RESERVE, 1)
+    if len(text) <= limit:
+        return (text,)
+
+    # 以分隔線為界切成段落，分隔線跟著前一段
+    entries, current = [], ""
+    for line in text.splitlines(keepends=True):
+        current += line
+        if PAGE_SEPARATOR_PATTERN.match(line.strip()):
+            entries.append(current)
+            current = ""
+    if current:
+        entries.append(current)
+
+    chunks, current = [], ""
+    for entry in entries:
+        for piece in (split_long_entry(entry, limit) if len(entry) > limit else [entry]):
+            if current and len(current) + len(piece) > limit:
+                chunks.append(current.rstrip("\n"))
+                current = ""
+                if PAGE_SEPARATOR_PATTERN.match(piece.strip()):
+                    continue
+            current += piece
+    if current.strip():
+        chunks.append(current.rstrip("\n"))
+    return tuple(chunks)
+
+def cached_pages(key, build):
+    """快取已分頁的回覆（與 cached_reply 共用同一個 LRU）"""
+    return cached_reply(("pages",) + tuple(key), lambda: paginate_text(build()))
+
+def page_cursor_key(user_id: str):
+    return f"page:{user_id}"
+
+def send_pages(event, user_id, reply, page: int = 1, total=None):
+    """送出第一批訊息（reply 可以是文字或已分頁的 tuple）；還有剩餘時把其餘頁面存入游標並加上頁尾提示"""
+    chunks = list(paginate_text(reply) if isinstance(reply, str) else reply)
+    total = total or -(-len(chunks) // REPLY_MAX_MESSAGES)
+    current, rest = chunks[:REPLY_MAX_MESSAGES], chunks[REPLY_MAX_MESSAGES:]
+    if rest:
+        current[-1] += f"\n📄 第 {page}/{total} 頁，輸入「{NEXT_PAGE_KEYWORD}」查看更多"
+        user_state[page_cursor_key(user_id)] = json.dumps({"page": page + 1, "total": total, "chunks": rest},
+                                                          ensure_ascii=False)
+    else:
+        if total > 1:
+            current[-1] += f"\n📄 第 {page}/{total} 頁（已顯示全部）"
+        user_state[page_cursor_key(user_id)] = None
+    send_reply(event.reply_token, [TextSendMessage(text=chunk) for chunk in current])
 
-            except Exception as e:
-                import traceback
-                print(traceback.format_exc())  # ✅ 顯示完整錯誤
-                reply_text = f"⚠️ 錯誤：{e}"
-
-            # 分段回覆
-            max_len = 1900
-            if len(reply_text) > max_len:
-                chunks = [reply_text[i:i + max_len] for i in range(0, len(reply_text), max_len)]
-                messages = [TextSendMessage(text=chunk) for chunk in chunks]
-            else:
-                messages = [TextSendMessage(text=reply_text)]
 
-            line_bot_api.reply_message(event.reply_token, messages)
-            return
+# ----------- 主處理邏輯 -----------
+# 每個意圖一個處理函式，由 route_message 的結果查表分派
 
-        # -------------------- #
-        # 🔹 二、月份查詢 → 查有哪些品項（支援類型分段）
-        # 範例：「7月有什麼水果」或「7月有什麼農產品」
-        # -------------------- #
-        month_match = re.search(r"(\d{1,2})\s*月", user_text)
-        if month_match:
-            month_num = int(month_match.group(1))
+def reply_tools(event, user_id, route):
+    """品項查詢（列出所有不重複品項）"""
+    data = crop_data
+    try:
+        if data.frame.empty:
+            reply_text = "⚠️ 尚未載入產期資料，請稍後再試。"
         else:
-            month_num = convert_chinese_month_to_number(user_text)
+            reply_text = cached_pages(("items", data), lambda: render_item_list(data))
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        record_error("tools")
+        reply_text = f"⚠️ 查詢品項時發生錯誤：{e}"
 
-        if month_num:
-            print(f"📅 偵測到月份查詢：{month_num}月")
+    send_pages(event, user_id, reply_text)
 
-            if df_crop.empty:
-                reply_text = "⚠️ 尚未載入產期資料，請稍後再試。"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                return
+def reply_quiz(event, user_id, route):
+    user_state[user_id] = "search"
+    msg = "很抱歉，答題果園目前尚未開發完畢🙏\n你可以使用月份、蔬果種類、鄉鎮市等進行查詢功能\n也可以使用即時資訊進行市場價查詢"
+    send_reply(event.reply_token, TextSendMessage(text=msg))
 
-            # 嘗試判斷是否有指定類型（水果、蔬菜等）
-            crop_type = None
-            for t in TYPE_KEYWORDS + list(TYPE_ALIASES.keys()):
-                if t in user_text:
-                    crop_type = TYPE_ALIASES.get(t, t)
-                    break
-
-
-            # 篩選該月份資料
-            month_data = df_crop[df_crop["月份"].astype(str).str.contains(f"{month_num}", na=False)]
-            if crop_type:
-                month_data = month_data[month_data["類型"].astype(str).str.contains(crop_type, na=False)]
-
-            if not month_data.empty:
-                if crop_type:
-                    # ✅ 有指定類型，直接列出品項
-                    items = list(dict.fromkeys(month_data["品項"].astype(str).tolist()))
-                    if len(items) > 30:
-                        items = items[:30]
-                    joined_items = "、".join(items)
-                    reply_text = f"{month_num}月的{crop_type}有：{joined_items}。"
-                else:
-                    # ✅ 沒指定類型 → 分類分段顯示
-                    grouped = month_data.groupby("類型")
-                    reply_text = f"🍀 {month_num}月盛產的農產品如下：\n=====================\n"
-
-                    for gtype in TYPE_KEYWORDS:
-                        if gtype in grouped.groups:
-                            sub = grouped.get_group(gtype)
-                            items = list(dict.fromkeys(sub["品項"].astype(str).tolist()))
-                            if len(items) > 30:
-                                items = items[:30]
-                            joined_items = "、".join(items)
-                            reply_text += f"【{gtype}】\n{joined_items}\n---------------------\n"
-
-                    # 額外處理不在 TYPE_KEYWORDS 的其他類型
-                    other_types = [t for t in grouped.groups.keys() if t not in TYPE_KEYWORDS]
-                    for t in other_types:
-                        sub = grouped.get_group(t)
-                        items = list(dict.fromkeys(sub["品項"].astype(str).tolist()))
-                        if len(items) > 30:
-                            items = items[:30]
-                        joined_items = "、".join(items)
-                        reply_text += f"【{t}】\n{joined_items}\n---------------------\n"
+def reply_weekly(event, user_id, route):
+    try:
+        reply_text = cached_pages(weekly_digest_key(), render_weekly_digest)
+    except Exception as e:
+        record_error("weekly")
+        print(traceback.format_exc())
+        reply_text = f"⚠️ 產生本周水果報時發生錯誤：{e}"
 
-            else:
-                reply_text = f"❌ 查無 {month_num} 月的{crop_type or '農產品'}資料。"
+    send_pages(event, user_id, reply_text)
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
+def reply_search_entry(event, user_id, route):
+    """即時查詢入口"""
+    user_state[user_id] = "search"
+    msg = "請輸入想查詢的水果名稱（例如：香蕉、芭樂、火龍果）\n點擊連結查看未來一周的氣象預報\nhttps://www.cwa.gov.tw/V8/C/W/week.html"
+    send_reply(event.reply_token, TextSendMessage(text=msg))
 
-        # -------------------- #
-        # 偵測地區查詢（支援分項分類顯示）
-        # -------------------- #
-        regions, crop_type = detect_region_and_type(user_text)
-        if regions:
-            print(f"🗺️ 偵測到地區：{regions}, 類型：{crop_type}")
+def reply_search(event, user_id, route, user_text):
+    """即時查詢模式：查最新交易日的市場價格"""
+    user_state[user_id] = None
+    crop_name_input = re.sub(r"[\s　]+", "", user_text)
+    print(f"🔍 搜尋關鍵字：{crop_name_input}")
 
-            try:
-                if df_crop.empty:
-                    raise ValueError("產期資料尚未載入")
-
-                # ✅ 可多縣市查詢
-                region_data = pd.concat([
-                    df_crop[df_crop["縣市"].astype(str).str.contains(region, na=False)]
-                    for region in regions
-                ], ignore_index=True)
-
-                if crop_type:
-                    # ✅ 若有明確類型，僅顯示該類型
-                    region_data = region_data[
-                        region_data["類型"].astype(str).str.contains(crop_type, na=False)
-                    ]
-
-                if not region_data.empty:
-                    shown_region = "、".join([r.replace("臺", "台") for r in regions])
-
-                    # ✅ 若有指定 crop_type，維持舊格式
-                    if crop_type:
-                        items = list(dict.fromkeys(region_data["品項"].astype(str).tolist()))
-                        joined_items = "、".join(items)
-                        reply_text = f"{shown_region}盛產的{crop_type}有：{joined_items}。"
-
-                    else:
-                        # ✅ 沒有指定類型 → 依類型分組顯示
-                        grouped = region_data.groupby("類型")
-                        reply_text = f"🍀 {shown_region}盛產項目如下：\n"
-                        reply_text += "=====================\n"
-
-                        for gtype in TYPE_KEYWORDS:
-                            if gtype in grouped.groups:
-                                sub = grouped.get_group(gtype)
-                                items = list(dict.fromkeys(sub["品項"].astype(str).tolist()))
-                                joined_items = "、".join(items)
-                                reply_text += f"【{gtype}】\n{joined_items}\n---------------------\n"
-
-                        # 若有額外類型（不在預設四種）
-                        other_types = [t for t in grouped.groups.keys() if t not in TYPE_KEYWORDS]
-                        for t in other_types:
-                            sub = grouped.get_group(t)
-                            items = list(dict.fromkeys(sub["品項"].astype(str).tolist()))
-                            joined_items = "、".join(items)
-                            reply_text += f"【{t}】\n{joined_items}\n---------------------\n"
-
-                else:
-                    shown_region = "、".join([r.replace("臺", "台") for r in regions])
-                    reply_text = f"❌ 查無 {shown_region} 的{crop_type or '農產品'}資料。"
+    try:
+        prices = df  # 取用當下的快照，重新載入時不受影響
+        if prices.empty:
+            raise ValueError("即時行情資料尚未載入")
+
+        if not all(col in prices.columns for col in required_cols):
+            raise KeyError(f"欄位名稱不符，目前 CSV 欄位：{prices.columns.tolist()}")
+
+        latest_date, latest_rows = latest_price_rows(prices, crop_name_input)
+
+        if latest_rows:
+            reply_text = f"📅 最新交易日期：{latest_date}\n🍎 查詢關鍵字：{crop_name_input}\n------------------------\n"
+            for product, market, avg_price, change_text in latest_rows:
+                try:
+                    change = float(change_text)
+                except ValueError:
+                    change = 0
+                arrow = "📈" if change > 0 else "📉" if change < 0 else "💲"
+
+                reply_text += (
+                    f"🥭 品項：{product}\n"
+                    f"🏬 市場：{market}\n"
+                    f"💰 平均價：{avg_price} 元/公斤\n"
+                    f"{arrow} 價格漲幅(%)：{change_text} %\n"
+                    "------------------------\n"
+                )
+        else:
+            reply_text = f"查無「{crop_name_input}」的市場價格資料。"
+            # 只提示查得到行情的品名
+            suggestion = suggest_crop_name(
+                crop_name_input, accept=lambda word: bool(latest_price_rows(prices, word)[1]))
+            if suggestion:
+                reply_text += f"\n您是不是要找「{suggestion}」？"
 
-            except Exception as e:
-                import traceback
-                print(traceback.format_exc())
-                reply_text = f"⚠️ 查詢地區資料時發生錯誤：{e}"
+    except Exception as e:
+        import traceback
+        record_error("search")
+        print(traceback.format_exc())  # ✅ 顯示完整錯誤
+        reply_text = f"⚠️ 錯誤：{e}"
 
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            return
+    # 依品項段落分頁回覆
+    send_pages(event, user_id, reply_text)
 
+def reply_history(event, user_id, route):
+    """歷史行情查詢（N 天均價 / 走勢）"""
+    print(f"📊 偵測到歷史行情查詢：{route.history}")
+    try:
+        reply_text = cached_pages(("history",) + route.history,
+                                  lambda: render_price_history(*route.history))
+    except Exception as e:
+        record_error("history")
+        print(traceback.format_exc())
+        reply_text = f"⚠️ 查詢歷史行情時發生錯誤：{e}"
 
-        # -------------------- #
-        # 自動偵測產期查詢（主功能）
-         # -------------------- #
-        crop_inputs = re.split(r"[、,，\s]+", user_text)
-        crop_inputs = [normalize_crop_name(c) for c in crop_inputs if c]
+    send_pages(event, user_id, reply_text)
 
-        if not crop_inputs:
-            msg = "請輸入水果名稱，例如：香蕉、芭樂、火龍果"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=msg))
-            return
+def reply_month(event, user_id, route):
+    """月份查詢 → 查有哪些品項（支援類型分段），例如「7月有什麼水果」"""
+    months, crop_type = tuple(route.months), route.crop_type
+    print(f"📅 偵測到月份查詢：{'、'.join(str(m) for m in months)}月")
 
-        reply_text = ""
-        found_any = False
-
-        for crop_input in crop_inputs:
-            alias = expand_fruit_alias(crop_input)
-            results = match_crop_in_period_data(crop_input)
-
-            if results.empty and alias != crop_input:
-                results = match_crop_in_period_data(alias)
-
-            if not results.empty:
-                found_any = True
-                reply_text += f"🍀 查詢作物：{crop_input}\n=====================\n"
-
-                # ✅ 合併相同項目的不同月份
-                # 以 類型、品項、品種、縣市 為群組鍵，將月份合併
-                grouped = (
-                        results.groupby(["類型", "品項", "品種", "縣市"], dropna=False)
-                        .agg({"月份": sort_months_numerically})
-                        .reset_index()
-                        )
-
-                # 輸出整理後的結果
-                for _, row in grouped.iterrows():
-                    parts = []
-                    if "類型" in row and str(row["類型"]).strip():
-                        parts.append(f"類型：{row['類型']}")
-                    if "品項" in row and str(row["品項"]).strip():
-                        parts.append(f"品項：{row['品項']}")
-                    if "品種" in row and str(row["品種"]).strip():
-                        parts.append(f"品種：{row['品種']}")
-                    if "縣市" in row and str(row["縣市"]).strip():
-                        parts.append(f"縣市：{row['縣市']}")
-                    if "月份" in row and str(row["月份"]).strip():
-                        parts.append(f"月份：{row['月份']}")
-
-                    reply_text += "\n".join(parts) + "\n---------------------\n"
+    data = crop_data
+    if data.empty:
+        reply_text = "⚠️ 尚未載入產期資料，請稍後再試。"
+    else:
+        reply_text = cached_pages(("month", data, months, crop_type),
+                                  lambda: render_month_reply(months, crop_type, data))
 
-            else:
-                reply_text += f"❌ 查無 {crop_input} 的產期資料。\n---------------------\n"
+    send_pages(event, user_id, reply_text)
 
-        if not found_any:
-            reply_text = f"⚠️錯誤的回訊方式，可以點擊輔助功能來確認可查詢的品項"
+def reply_region(event, user_id, route):
+    """地區查詢（支援分項分類顯示）"""
+    regions, crop_type = route.regions, route.crop_type
+    print(f"🗺️ 偵測到地區：{regions}, 類型：{crop_type}")
 
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-        return
+    data = crop_data
+    try:
+        reply_text = cached_pages(("region", data, tuple(regions), crop_type),
+                                  lambda: render_region_reply(regions, crop_type, data))
 
     except Exception as e:
         import traceback
         print(traceback.format_exc())
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 系統發生錯誤，請稍後再試。"))
+        record_error("region")
+        reply_text = f"⚠️ 查詢地區資料時發生錯誤：{e}"
+
+    send_pages(event, user_id, reply_text)
+
+def render_crop_reply(crop_inputs, data=None):
+    """多個作物的產期段落，回傳 (文字, 是否有任一作物查到資料, 建議詞清單)"""
+    data = data or crop_data
+    reply_text = ""
+    found_any = False
+    suggestions = []
+    for crop_input in crop_inputs:
+        section, found, suggestion = cached_reply(("crop", data, crop_input),
+                                                  lambda: render_crop_section(crop_input, data))
+        reply_text += section
+        found_any = found_any or found
+        if suggestion:
+            suggestions.append(suggestion)
+    return reply_text, found_any, suggestions
+
+def reply_crops(event, user_id, route, user_text):
+    """自動偵測產期查詢（主功能）"""
+    crop_inputs = re.split(r"[、,，\s]+", user_text)
+    crop_inputs = [normalize_crop_name(c) for c in crop_inputs if c]
+
+    if not crop_inputs:
+        msg = "請輸入水果名稱，例如：香蕉、芭樂、火龍果"
+        send_reply(event.reply_token, TextSendMessage(text=msg))
+        return "miss"
+
+    # 沒有分隔符號的「香蕉芭樂」之類輸入，改用掃描時找到的已知品項
+    if len(crop_inputs) == 1 and len(route.crops) > 1:
+        crop_inputs = route.crops
+
+    reply_text, found_any, suggestions = render_crop_reply(crop_inputs, crop_data)
+
+    if not found_any:
+        reply_text = f"⚠️錯誤的回訊方式，可以點擊輔助功能來確認可查詢的品項"
+        if suggestions:
+            reply_text += "\n您是不是要找「" + "」、「".join(dict.fromkeys(suggestions)) + "」？"
+
+    send_pages(event, user_id, reply_text)
+    return "crop" if found_any else "miss"
+
+def reply_next_page(event, user_id, route):
+    """「下一頁」：從使用者游標取出預先排好的下一批訊息"""
+    cursor = user_state.get(page_cursor_key(user_id))
+    if not cursor:
+        msg = "目前沒有更多資料了，請重新輸入查詢內容。"
+        send_reply(event.reply_token, TextSendMessage(text=msg))
+        return
+    cursor = json.loads(cursor)
+    send_pages(event, user_id, cursor["chunks"], page=cursor["page"], total=cursor["total"])
+
+INTENT_HANDLERS = {
+    "tools": reply_tools,
+    "quiz": reply_quiz,
+    "weekly": reply_weekly,
+    "search_entry": reply_search_entry,
+    "next_page": reply_next_page,
+    "history": reply_history,
+    "month": reply_month,
+    "region": reply_region,
+}
 
+# /callback 只用 handler.parser 驗簽解析，再由 dispatch_event 呼叫，不向 handler 註冊
+def handle_message(event):
+    try:
+        user_id = event.source.user_id
+        user_text = event.message.text.strip()
 
+        print(f"📩 收到使用者輸入：{user_text}")
+        route = route_message(user_text)
 
+        # 選單以外的訊息，若使用者剛點過「即時資訊」則視為行情查詢
+        if route.intent not in MENU_INTENTS.values() and user_state.get(user_id) == "search":
+            record_intent("search")
+            reply_search(event, user_id, route, user_text)
+            return
 
+        if route.intent == "crop":
+            record_intent(reply_crops(event, user_id, route, user_text))
+            return
 
+        record_intent(route.intent)
+        INTENT_HANDLERS[route.intent](event, user_id, route)
 
+    except Exception as e:
+        import traceback
+        record_error("handler")
+        print(traceback.format_exc())
+        send_reply(event.reply_token, TextSendMessage(text="⚠️ 系統發生錯誤，請稍後再試。"))
+
+# ----------- 重送去重與限流 -----------
+# webhook 逾時時 LINE 會重送同一事件：以 webhookEventId 記住最近處理過的事件（有上限、會過期），重複的直接略過。
+# 重送不一定落在同一個 gunicorn worker：SESSION_BACKEND=sqlite（預設）時與使用者狀態共用同一個 SQLite 檔，
+# 所有 worker 看到同一份記錄；memory 時只在行程內去重，多個 worker 之間的重送仍可能被處理兩次。
+# 每位使用者與整體各一個令牌桶，超出時在進入查詢前就處理掉：先回一則固定的「請稍後再試」，
+# 同一使用者在 SHED_NOTICE_INTERVAL 內再超出就直接丟棄，不再呼叫 LINE API
+
+EVENT_DEDUP_TTL = float(os.environ.get("EVENT_DEDUP_TTL", "3600"))
+EVENT_DEDUP_SIZE = int(os.environ.get("EVENT_DEDUP_SIZE", "20000"))
+# 每秒補充的令牌數與最多累積的令牌數，速率為 0 表示不限制
+USER_RATE_LIMIT = float(os.environ.get("USER_RATE_LIMIT", "1"))
+USER_RATE_BURST = float(os.environ.get("USER_RATE_BURST", "5"))
+GLOBAL_RATE_LIMIT = float(os.environ.get("GLOBAL_RATE_LIMIT", "100"))
+GLOBAL_RATE_BURST = float(os.environ.get("GLOBAL_RATE_BURST", "200"))
+RATE_LIMIT_MAX_USERS = int(os.environ.get("RATE_LIMIT_MAX_USERS", "10000"))
+SHED_NOTICE_INTERVAL = float(os.environ.get("SHED_NOTICE_INTERVAL", "30"))
+BUSY_REPLY = TextSendMessage(text="⚠️ 訊息有點多，請稍等幾秒再試一次🙏")
+
+metrics.describe("linebot_duplicate_events_total", "counter", "Webhook events skipped as already processed")
+metrics.describe("linebot_shed_total", "counter", "Messages shed by rate limit scope and action")
+
+class RecentEvents(LRUCache):
+    """行程內最近處理過的事件 ID（LRU + 存活時間）"""
+
+    def seen(self, event_id: str):
+        """已經看過回傳 True；否則記下來並回傳 False"""
+        return not self.add(event_id, True)
+
+class SQLiteRecentEvents(ExpiringSQLiteStore):
+    """以 SQLite 檔案記錄最近處理過的事件 ID，多個 worker 行程共用（超過上限時淘汰最早過期的事件）"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS recent_events (
+            event_id   TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_recent_events_expires ON recent_events (expires_at);
+    """
+    TABLE, KEY = "recent_events", "event_id"
+
+    def seen(self, event_id: str):
+        """已經看過回傳 True；否則記下來並回傳 False（單一 UPSERT，多個行程同時收到時只有一個回傳 False）"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO recent_events VALUES (?, ?) ON CONFLICT (event_id) "
+            "DO UPDATE SET expires_at = excluded.expires_at WHERE recent_events.expires_at <= ?",
+            (event_id, now + self.ttl, now))
+        if not cursor.rowcount:
+            return True
+        self._wrote()
+        return False
+
+def create_recent_events():
+    """依 SESSION_BACKEND 建立事件去重記錄，SQLite 無法使用時退回行程內記錄"""
+    if SESSION_BACKEND == "sqlite":
+        try:
+            return SQLiteRecentEvents(SESSION_DB_PATH, EVENT_DEDUP_SIZE, EVENT_DEDUP_TTL)
+        except Exception as e:
+            print("❌ 無法開啟事件去重資料庫，改用行程內記錄:", e)
+    return RecentEvents(EVENT_DEDUP_SIZE, EVENT_DEDUP_TTL)
+
+class TokenBucket:
+    """令牌桶：每秒補充 rate 個令牌，最多累積 burst 個"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = now
+
+    def take(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class LoadShedder:
+    """每位使用者與整體的令牌桶，回傳 "ok"、"degrade"（回固定短訊息）或 "drop"（不回覆）"""
+
+    def __init__(self, user_rate, user_burst, global_rate, global_burst, max_users: int, notice_interval: float):
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.max_users = max_users
+        self.notice_interval = notice_interval
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic()) if global_rate > 0 else None
+        self._users = LRUCache(max_users)
+        # 提醒過的使用者在 notice_interval 內不再提醒
+        self._notices = LRUCache(max_users, ttl=notice_interval)
+        self._lock = Lock()
+        self.counts = Counter()
+
+    def _user_ok(self, user_id, now):
+        if self.user_rate <= 0:
+            return True
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            # 超過 max_users 時淘汰最久沒發訊息的使用者，他們的令牌早已補滿，不影響結果
+            bucket = TokenBucket(self.user_rate, self.user_burst, now)
+            self._users.put(user_id, bucket)
+        return bucket.take(now)
+
+    def admit(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            if not self._user_ok(user_id, now):
+                scope = "user"
+            elif self.global_bucket is not None and not self.global_bucket.take(now):
+                scope = "global"
+            else:
+                self.counts["admitted"] += 1
+                return "ok"
+
+            # 同一使用者短時間內只提醒一次
+            action = "degrade" if self._notices.add(user_id, True) else "drop"
+            self.counts[f"{scope}_{action}"] += 1
+        metrics.inc("linebot_shed_total", scope=scope, action=action)
+        return action
+
+    def stats(self):
+        with self._lock:
+            return {"tracked_users": len(self._users), **self.counts}
+
+recent_events = create_recent_events()
+load_shedder = LoadShedder(USER_RATE_LIMIT, USER_RATE_BURST, GLOBAL_RATE_LIMIT, GLOBAL_RATE_BURST,
+                           RATE_LIMIT_MAX_USERS, SHED_NOTICE_INTERVAL)
+
+def is_duplicate_event(event):
+    """以 webhookEventId 判斷是否為已處理過的事件（含 LINE 的重送）"""
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id or EVENT_DEDUP_TTL <= 0 or not recent_events.seen(event_id):
+        return False
+    context = getattr(event, "delivery_context", None)
+    redelivery = bool(getattr(context, "is_redelivery", False))
+    metrics.inc("linebot_duplicate_events_total", redelivery=str(redelivery).lower())
+    return True
+
+# ----------- 背景回覆工作池 -----------
+# WEBHOOK_MODE=async 時，webhook 只負責驗證簽章與排入佇列，
+# 查詢與 reply_message 交給固定數量的背景執行緒處理
+
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "sync")
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "200"))
+# 佇列滿時的處理方式：drop_newest（丟棄新事件）、drop_oldest（丟棄最舊事件）、inline（在請求中直接處理）
+WEBHOOK_OVERFLOW_POLICY = os.environ.get("WEBHOOK_OVERFLOW_POLICY", "drop_newest")
+# 佇列滿時先等待的秒數（背壓），超過才套用上面的處理方式
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_ENQUEUE_TIMEOUT", "0.05"))
+
+event_queue = Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_stats = {"enqueued": 0, "processed": 0, "dropped": 0, "inline": 0, "errors": 0, "duplicates": 0}
+# 請求執行緒與背景工作池都會更新 webhook_stats，+= 不是原子操作，一律持鎖更新與讀取
+_webhook_stats_lock = Lock()
+_worker_lock = Lock()
+_worker_pid = None
+
+def count_webhook_event(outcome: str):
+    with _webhook_stats_lock:
+        webhook_stats[outcome] += 1
+
+def webhook_stats_snapshot():
+    with _webhook_stats_lock:
+        return dict(webhook_stats)
+
+def dispatch_event(event):
+    """將單一事件交給對應的處理函式"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        # 超出限流時在查詢前就結束
+        action = load_shedder.admit(event.source.user_id)
+        if action == "degrade":
+            try:
+                send_reply(event.reply_token, BUSY_REPLY)
+            except Exception:
+                record_error("shed")
+        if action != "ok":
+            return
+        # handle_message 本身的淨耗時即為意圖判斷（查詢、產生文字、回覆各自另計）
+        with span("intent"):
+            handle_message(event)
+
+def event_worker():
+    """背景執行緒：持續從佇列取出事件並處理"""
+    while True:
+        event = event_queue.get()
+        try:
+            dispatch_event(event)
+            count_webhook_event("processed")
+        except Exception:
+            count_webhook_event("errors")
+            record_error("worker")
+            print(traceback.format_exc())
+        finally:
+            event_queue.task_done()
+
+def start_event_workers():
+    """啟動背景工作池（gunicorn fork 後執行緒不會被繼承，因此以 PID 判斷是否需重新啟動）"""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        for i in range(WEBHOOK_WORKERS):
+            Thread(target=event_worker, name=f"event-worker-{i}", daemon=True).start()
+        _worker_pid = os.getpid()
+
+def enqueue_event(event):
+    """將事件排入佇列，佇列已滿時依 WEBHOOK_OVERFLOW_POLICY 處理"""
+    start_event_workers()
+    try:
+        event_queue.put(event, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        count_webhook_event("enqueued")
+        return
+    except Full:
+        pass
 
+    if WEBHOOK_OVERFLOW_POLICY == "inline":
+        count_webhook_event("inline")
+        dispatch_event(event)
+        return
+
+    if WEBHOOK_OVERFLOW_POLICY == "drop_oldest":
+        try:
+            event_queue.get_nowait()
+            event_queue.task_done()
+            count_webhook_event("dropped")
+        except Empty:
+            pass
+        try:
+            event_queue.put_nowait(event)
+            count_webhook_event("enqueued")
+            return
+        except Full:
+            pass
+
+    count_webhook_event("dropped")
+    print(f"⚠️ 事件佇列已滿（{WEBHOOK_QUEUE_SIZE}），丟棄事件")
+
+def collect_runtime_metrics():
+    """抓取 /metrics 時才讀取的快取與工作池狀態"""
+    cache = reply_cache.stats()
+    return [
+        ("linebot_reply_cache_hits_total", "counter", "Reply cache hits", [({}, cache["hits"])]),
+        ("linebot_reply_cache_misses_total", "counter", "Reply cache misses", [({}, cache["misses"])]),
+        ("linebot_reply_cache_size", "gauge", "Entries in the reply cache", [({}, cache["size"])]),
+        ("linebot_webhook_events_total", "counter", "Webhook events by outcome",
+         [({"outcome": k}, v) for k, v in webhook_stats_snapshot().items()]),
+        ("linebot_event_queue_depth", "gauge", "Events waiting in the worker queue", [({}, event_queue.qsize())]),
+    ]
+
+metrics.add_collector(collect_runtime_metrics)
+
+# ----------- 上游開放資料抓取 -----------
+# 定期以條件式 GET（ETag / If-Modified-Since）向上游抓取行情與產期 CSV，沒有更新時上游回 304、不必下載；
+# 有新內容時邊下載邊逐行解析，只留下目前資料還沒有的列，在背景執行緒合併成新快照後一次替換，
+# 處理中的請求仍使用原本持有的資料
+
+PRICE_FEED_URL = os.environ.get("PRICE_FEED_URL", "")
+CROP_FEED_URL = os.environ.get("CROP_FEED_URL", "")
+# 抓取間隔秒數，0 表示不定期抓取（仍可用 fetch_feeds.py 手動抓取）
+FEED_FETCH_INTERVAL = float(os.environ.get("FEED_FETCH_INTERVAL", "3600"))
+FEED_TIMEOUT = float(os.environ.get("FEED_TIMEOUT", "30"))
+
+metrics.describe("linebot_feed_fetches_total", "counter", "Upstream feed fetches by HTTP status")
+metrics.describe("linebot_feed_bytes_total", "counter", "Bytes received from upstream feeds (compressed)")
+metrics.describe("linebot_feed_rows_total", "counter", "New rows merged from upstream feeds")
+
+def iter_csv_records(lines):
+    """逐行解析 CSV，回傳 (去除空白後的欄位名稱, 其餘資料列的 iterator)"""
+    reader = csv.reader(lines)
+    header = next(reader, [])
+    return [re.sub(r"\s+", "", h).replace("\ufeff", "") for h in header], reader
+
+def merge_price_feed(lines):
+    """只保留 df 尚未包含的交易日，解析成 DataFrame 後附加到目前的行情資料，回傳新增筆數"""
+    header, records = iter_csv_records(lines)
+    if "日期" not in header:
+        raise KeyError(f"欄位名稱不符，上游欄位：{header}")
+    date_col = header.index("日期")
+    base = df
+    held_dates = set(base["日期"].astype(str).str.strip()) if "日期" in base.columns else set()
+
+    # 只把新交易日的列重新寫成 CSV 交給 pandas，舊資料不會被解析成 DataFrame
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    added = 0
+    for record in records:
+        if len(record) > date_col and record[date_col].strip() and record[date_col].strip() not in held_dates:
+            writer.writerow(record)
+            added += 1
+    if not added:
+        return 0
+    buffer.seek(0)
+    new_rows = add_price_derived_columns(normalize_price_columns(pd.read_csv(buffer)))
+
+    with _price_reload_lock:
+        # 下載期間行情檔可能已被重新載入，以最新的 df 再過濾一次
+        if df is not base and "日期" in df.columns:
+            new_rows = new_rows[~new_rows["日期"].astype(str).isin(set(df["日期"].astype(str)))]
+        added = len(new_rows)
+        if added:
+            publish_price_snapshot(pd.concat([df, new_rows], ignore_index=True) if not df.empty else new_rows, added)
+    if added:
+        rebuild_crop_matcher()
+        invalidate_reply_cache()
+    return added
+
+_crop_reload_lock = Lock()
+
+def merge_crop_feed(lines):
+    """只保留目前產期資料尚未包含的列（整列比對），合併後重建產期索引，回傳新增筆數"""
+    header, records = iter_csv_records(lines)
+    base = crop_data.frame
+    if not base.empty and header != base.columns.tolist():
+        raise KeyError(f"欄位名稱不符，上游欄位：{header}")
+    held = set(base.astype(str).itertuples(index=False, name=None))
+    new_rows = []
+    for record in records:
+        row = tuple(v.strip().replace("　", "") for v in record)
+        # 欄位數不符的列與 load_crop_frame（on_bad_lines="skip"）一樣略過
+        if len(row) == len(header) and row not in held:
+            held.add(row)
+            new_rows.append(row)
+    if not new_rows:
+        return 0
+
+    with _crop_reload_lock:
+        current = crop_data.frame
+        # 下載期間產期資料可能已被替換，以最新的資料再過濾一次
+        if current is not base:
+            held = set(current.astype(str).itertuples(index=False, name=None))
+            new_rows = [row for row in new_rows if row not in held]
+            if not new_rows:
+                return 0
+        frame = prepare_crop_frame(pd.DataFrame(new_rows, columns=header, dtype="category"))
+        if not current.empty:
+            frame = pd.concat([current, frame], ignore_index=True)
+            for col in frame.columns:
+                if frame[col].dtype.kind not in "iu":
+                    frame[col] = frame[col].astype(str).astype("category")
+        publish_crop_frame(frame)
+    return len(new_rows)
+
+def publish_crop_frame(frame):
+    """以新的產期資料建立新的一份 CropData 後一次替換，再重建錯字比對（呼叫端需持有 _crop_reload_lock）"""
+    global crop_data
+    data = build_crop_data(frame)
+    crop_data = data
+    # 舊資料的記憶結果不再需要，清掉以免持有舊的 CropData
+    crop_season_positions.cache_clear()
+    rebuild_crop_matcher(data)
+    invalidate_reply_cache()
+
+class UpstreamFeed:
+    """單一上游 CSV：記住上次回應的 ETag / Last-Modified，下次以條件式 GET 抓取"""
+
+    def __init__(self, name: str, url: str, merge):
+        self.name = name
+        self.url = url
+        self.merge = merge
+        self.etag = None
+        self.last_modified = None
+        self.last = {}
+
+    def fetch(self, session):
+        """抓取一次，回傳新增筆數（304 時為 0）"""
+        headers = {"Accept-Encoding": "gzip"}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        start = time.perf_counter()
+        with session.get(self.url, headers=headers, stream=True, timeout=FEED_TIMEOUT) as response:
+            metrics.inc("linebot_feed_fetches_total", feed=self.name, status=str(response.status_code))
+            added, wire_bytes = 0, 0
+            if response.status_code != 304:
+                response.raise_for_status()
+                response.encoding = "utf-8-sig"
+                added = self.merge(response.iter_lines(chunk_size=65536, decode_unicode=True))
+                # 壓縮傳輸時為實際收到的位元組數
+                wire_bytes = response.raw.tell()
+                # 合併成功才記住驗證值；解析失敗時下次會重新完整下載
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+
+        metrics.inc("linebot_feed_bytes_total", wire_bytes, feed=self.name)
+        metrics.inc("linebot_feed_rows_total", added, feed=self.name)
+        self.last = {"status": response.status_code, "added": added, "bytes": wire_bytes,
+                     "encoding": response.headers.get("Content-Encoding", "identity"),
+                     "seconds": round(time.perf_counter() - start, 4), "at": time.time()}
+        return added
+
+    def stats(self):
+        return {"url": self.url, "etag": self.etag, "last_modified": self.last_modified, **self.last}
+
+upstream_feeds = [feed for feed in (UpstreamFeed("price", PRICE_FEED_URL, merge_price_feed),
+                                    UpstreamFeed("crop", CROP_FEED_URL, merge_crop_feed)) if feed.url]
+
+def fetch_feeds(session):
+    """每個上游各抓一次，回傳 {名稱: 新增筆數}（失敗時為 None）"""
+    results = {}
+    for feed in upstream_feeds:
+        try:
+            results[feed.name] = feed.fetch(session)
+            if results[feed.name]:
+                print(f"🌐 已從上游合併新資料（{feed.name}），新增 {results[feed.name]} 筆。")
+        except Exception:
+            results[feed.name] = None
+            record_error("feed")
+            print(f"❌ 無法抓取上游資料（{feed.url}）:")
+            print(traceback.format_exc())
+    return results
+
+def feed_fetcher():
+    """背景執行緒：啟動後先抓一次，之後定期抓取（連線只在此執行緒內使用）"""
+    session = requests.Session()
+    while True:
+        fetch_feeds(session)
+        time.sleep(FEED_FETCH_INTERVAL)
+
+_feed_fetcher_pid = None
+# 同 _watcher_start_lock，與合併上游資料用的 _crop_reload_lock 分開
+_feed_fetcher_start_lock = Lock()
+
+def start_feed_fetcher():
+    """啟動上游抓取執行緒（每個 gunicorn worker 各自一條，原因見 gunicorn.conf.py）"""
+    global _feed_fetcher_pid
+    if FEED_FETCH_INTERVAL <= 0 or not upstream_feeds or _feed_fetcher_pid == os.getpid():
+        return
+    with _feed_fetcher_start_lock:
+        if _feed_fetcher_pid == os.getpid():
+            return
+        Thread(target=feed_fetcher, name="feed-fetcher", daemon=True).start()
+        _feed_fetcher_pid = os.getpid()
 
+# 所有啟動資料都建好後，有重建的項目才寫回快照檔
+data_snapshot.save()
 
 if __name__ == "__main__":
     # 允許外部訪問，Cloudflare Tunnel 需要
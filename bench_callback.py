@@ -0,0 +1,295 @@
+"""/callback 重播與壓力測試
+
+產生帶正確簽章的 LINE MessageEvent，涵蓋每一種意圖分支，直接對 Flask app 送出，
+LINE 回覆 API 以本機假函式取代（可模擬延遲），最後輸出各分支的吞吐量與 p50/p95/p99 延遲。
+
+用法：
+    python bench_callback.py --requests 200 --concurrency 4 --output bench_results.json
+    python bench_callback.py --cold            # 關閉回覆快取，量測每次都重新查詢的成本
+    python bench_callback.py --reply-latency 0.05 --branches month region
+    python bench_callback.py --stub-api --stub-fail-rate 0.1   # 改走真正的 HTTP client，對本機假 LINE API 送出
+    WEBHOOK_MODE=async python bench_callback.py --stub-api --stub-fail-rate 0.1   # 重試只在 webhook 請求之外進行
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+
+# 必須在 import app 之前設定，否則 LineBotApi 無法建立
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench-secret")
+os.environ.setdefault("PRICE_RELOAD_INTERVAL", "0")
+# 壓測時不套用整體限流（每位使用者的限流仍保留，由 flood 分支量測）
+os.environ.setdefault("GLOBAL_RATE_LIMIT", "0")
+# 使用者狀態、行情資料庫與啟動快照另存一份，不影響工作目錄裡正式的檔案
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "bench_sessions.db"))
+os.environ.setdefault("PRICE_DB_PATH", os.path.join(tempfile.gettempdir(), "bench_price_history.db"))
+os.environ.setdefault("DATA_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "bench_data_snapshot.bin"))
+
+# 各意圖分支的測試訊息；search 分支會先送「即時資訊」再送品名，只量測第二則；
+# flood 分支每個執行緒固定同一位使用者連續送出（觸發每位使用者限流）；
+# redelivery 分支每則事件再以 isRedelivery 重送一次，兩次都量測
+BRANCH_MESSAGES = {
+    "menu": ["輔助工具", "答題果園", "本周水果報"],
+    "search": ["香蕉", "椰子", "芭樂", "百香菓"],
+    "month": ["7月有什麼水果", "十二月有什麼蔬菜", "3月有什麼農產品", "1月"],
+    "region": ["台東水果", "新竹 嘉義", "屏東", "臺中蔬菜"],
+    "multi_crop": ["香蕉、芭樂、柳丁", "西瓜 高麗菜 鳳梨", "釋迦，蓮霧，木瓜，芒果"],
+    "history": ["芭樂近7天均價", "香蕉台北二 30天走勢"],
+    "miss": ["xyz", "你好", "火龍裹", "謝謝"],
+    "flood": ["香蕉", "7月有什麼水果", "台東水果", "芭樂近7天均價"],
+    "redelivery": ["香蕉", "7月有什麼水果", "台東水果"],
+}
+
+_ids = count(1)
+_ids_lock = Lock()
+# 事件去重記錄存在 SQLite 檔，每次執行的事件 ID 加上不同的前綴，才不會被當成上一次的重送
+RUN_ID = f"{int(time.time()) % 10 ** 7:07d}"
+
+
+def next_id():
+    with _ids_lock:
+        return next(_ids)
+
+
+def make_body(text: str, user_id: str, n=None, redelivery: bool = False):
+    """產生單一文字訊息事件的 webhook 內容（指定 n 時沿用同一個事件 ID）"""
+    n = next_id() if n is None else n
+    return json.dumps({
+        "destination": "Ubench",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "webhookEventId": f"01BENCH{RUN_ID}{n:012d}",
+            "deliveryContext": {"isRedelivery": redelivery},
+            "replyToken": f"bench-reply-{n}",
+            "source": {"type": "user", "userId": user_id},
+            "message": {"type": "text", "id": str(n), "quoteToken": f"q{n}", "text": text},
+        }],
+    }, ensure_ascii=False)
+
+
+def sign(body: str, secret: str):
+    return base64.b64encode(hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+
+def percentile(sorted_values, p: float):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, errors: int, elapsed: float):
+    values = sorted(latencies)
+    return {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed > 0 else None,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+    }
+
+
+class StubLineHandler(BaseHTTPRequestHandler):
+    """假的 LINE Messaging API：依設定的機率回 500/429，其餘回 200"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        roll = random.random()
+        if roll < self.server.fail_rate / 2:
+            status, extra = 500, {}
+        elif roll < self.server.fail_rate:
+            status, extra = 429, {"Retry-After": "0"}
+        else:
+            status, extra = 200, {}
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.statuses[status] = self.server.statuses.get(status, 0) + 1
+        body = b"{}" if status == 200 else b'{"message": "stub error"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency: float, fail_rate: float):
+    """在本機隨機埠啟動假 LINE API，回傳 server（server.server_address 為實際位址）"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLineHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.lock = Lock()
+    server.connections = 0
+    server.requests = 0
+    server.statuses = {}
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run_branch(app_module, branch: str, total: int, concurrency: int):
+    """以多個執行緒對單一分支送出 total 次請求，回傳 (延遲列表, 錯誤數, 總耗時)"""
+    secret = os.environ["LINE_CHANNEL_SECRET"]
+    messages = BRANCH_MESSAGES[branch]
+    latencies, errors = [], [0]
+    lock = Lock()
+    per_thread = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+    def post(client, text, user_id, n=None, redelivery=False):
+        body = make_body(text, user_id, n, redelivery)
+        start = time.perf_counter()
+        resp = client.post("/callback", data=body.encode(), content_type="application/json",
+                           headers={"X-Line-Signature": sign(body, secret)})
+        return time.perf_counter() - start, resp.status_code
+
+    def worker(worker_id: int, n: int):
+        client = app_module.app.test_client()
+        for i in range(n):
+            user_id = f"Ubench{branch}{worker_id}" + ("" if branch == "flood" else f"x{i}")
+            text = messages[i % len(messages)]
+            if branch == "search":
+                post(client, "即時資訊", user_id)
+            results = [post(client, text, user_id)]
+            if branch == "redelivery":
+                n = next_id()
+                results = [post(client, text, user_id, n), post(client, text, user_id, n, redelivery=True)]
+            with lock:
+                for elapsed, status in results:
+                    if status == 200:
+                        latencies.append(elapsed)
+                    else:
+                        errors[0] += 1
+
+    threads = [Thread(target=worker, args=(i, n)) for i, n in enumerate(per_thread) if n]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="/callback 重播與壓力測試")
+    parser.add_argument("--requests", type=int, default=200, help="每個分支送出的請求數")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時送出請求的執行緒數")
+    parser.add_argument("--branches", nargs="+", choices=sorted(BRANCH_MESSAGES), default=list(BRANCH_MESSAGES))
+    parser.add_argument("--reply-latency", type=float, default=0.0, help="假回覆 API 的模擬延遲（秒）")
+    parser.add_argument("--cold", action="store_true", help="關閉回覆快取")
+    parser.add_argument("--warmup", type=int, default=20, help="每個分支正式量測前的暖機請求數")
+    parser.add_argument("--stub-api", action="store_true", help="啟動本機假 LINE API，回覆改走真正的 HTTP client")
+    parser.add_argument("--stub-fail-rate", type=float, default=0.0, help="假 LINE API 回 500/429 的機率")
+    parser.add_argument("--output", default="bench_results.json", help="結果 JSON 檔路徑")
+    args = parser.parse_args(argv)
+
+    stub = None
+    if args.stub_api:
+        stub = start_stub_server(args.reply_latency, args.stub_fail_rate)
+        os.environ["LINE_API_ENDPOINT"] = "http://%s:%d" % stub.server_address
+        os.environ.setdefault("LINE_RETRY_BACKOFF", "0.01")
+
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+
+    replies = {"count": 0}
+
+    def stub_reply_message(reply_token, messages, *a, **kw):
+        if args.reply_latency:
+            time.sleep(args.reply_latency)
+        replies["count"] += 1
+
+    if stub is None:
+        app_module.line_bot_api.reply_message = stub_reply_message
+    if args.cold:
+        app_module.reply_cache.maxsize = 0
+
+    results = {}
+    # 應用程式每則訊息都會 print，量測時先關掉輸出
+    with contextlib.redirect_stdout(io.StringIO()):
+        for branch in args.branches:
+            if args.warmup:
+                run_branch(app_module, branch, args.warmup, 1)
+            latencies, errors, elapsed = run_branch(app_module, branch, args.requests, args.concurrency)
+            results[branch] = summarize(latencies, errors, elapsed)
+        if getattr(app_module, "WEBHOOK_MODE", "sync") == "async":
+            app_module.event_queue.join()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "pandas": sys.modules["pandas"].__version__,
+            "webhook_mode": getattr(app_module, "WEBHOOK_MODE", "sync"),
+            "requests_per_branch": args.requests,
+            "concurrency": args.concurrency,
+            "reply_latency_s": args.reply_latency,
+            "reply_cache": not args.cold,
+            "replies_sent": replies["count"] if stub is None else stub.statuses.get(200, 0),
+            "webhook": app_module.webhook_stats_snapshot(),
+            "shedding": app_module.load_shedder.stats(),
+            "stub_api": None if stub is None else {
+                "fail_rate": args.stub_fail_rate,
+                "requests": stub.requests,
+                "connections": stub.connections,
+                "statuses": stub.statuses,
+            },
+        },
+        "branches": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"{'branch':<12}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for branch, r in results.items():
+        print(f"{branch:<12}{r['throughput_rps'] or 0:>10.1f}{r['p50_ms'] or 0:>10.2f}"
+              f"{r['p95_ms'] or 0:>10.2f}{r['p99_ms'] or 0:>10.2f}{r['errors']:>8}")
+    print(f"📄 結果已寫入 {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
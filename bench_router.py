@@ -0,0 +1,154 @@
+"""意圖路由效能比較
+
+以大量合成訊息比較兩種路由方式：
+- 舊的逐段判斷：選單字串 → 歷史行情 regex → 月份 regex → 中文月份 → 縣市／類型 in 迴圈 → 分割作物
+- 同上，再對每個已知品項各做一次 in（舊做法要找出訊息中的作物名稱所需的成本）
+- 新的 route_message：預先編譯的月份 regex 與縣市／類型 in 判斷，只有作物查詢時才以品項 regex 找出作物名稱
+
+兩者只計路由本身（不含查詢與排版），並列出判斷結果不一致的訊息（預期只有十一月、十二月）。
+
+用法：
+    python bench_router.py --messages 100000
+    python bench_router.py --messages 20000 --long    # 每則訊息再加上一段長文字
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import re
+import time
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench-secret")
+os.environ.setdefault("PRICE_RELOAD_INTERVAL", "0")
+
+CHINESE_MONTHS = ["一", "二", "三", "四", "五", "六", "七", "八", "九", "十", "十一", "十二"]
+FILLERS = ["", "有什麼", "請問", "的", "想知道", "盛產", "？", "～"]
+NOISE = ["你好", "謝謝", "xyz", "哈囉", "今天天氣如何", "火龍裹", "香焦", "蘋果派", "好吃嗎"]
+
+
+def legacy_route(app_module, user_text: str):
+    """改版前 handle_message 的判斷順序（含十一月被當成一月的舊行為），回傳 (intent, month, regions, crop_type)"""
+    if user_text in app_module.MENU_INTENTS:
+        return app_module.MENU_INTENTS[user_text], None, [], None
+    if app_module.parse_history_query(user_text):
+        return "history", None, [], None
+
+    month_match = re.search(r"(\d{1,2})\s*月", user_text)
+    month_num = int(month_match.group(1)) if month_match else None
+    if not month_num:
+        for ch, num in app_module.chinese_to_num.items():
+            if f"{ch}月" in user_text:
+                month_num = num
+                break
+    if month_num:
+        crop_type = None
+        for t in app_module.TYPE_KEYWORDS + list(app_module.TYPE_ALIASES.keys()):
+            if t in user_text:
+                crop_type = app_module.TYPE_ALIASES.get(t, t)
+                break
+        return "month", month_num, [], crop_type
+
+    regions, crop_type = [], None
+    for short, full_list in app_module.CITY_MAP.items():
+        if short in user_text:
+            regions.extend(full_list)
+    for t in app_module.TYPE_KEYWORDS + list(app_module.TYPE_ALIASES.keys()):
+        if t in user_text:
+            crop_type = app_module.TYPE_ALIASES.get(t, t)
+            break
+    if regions:
+        return "region", None, regions, crop_type
+    return "crop", None, [], None
+
+
+def route_summary(route):
+    """只保留該意圖會用到的欄位，方便與舊版比較"""
+    if route.intent == "month":
+        return route.intent, route.month, [], route.crop_type
+    if route.intent == "region":
+        return route.intent, None, route.regions, route.crop_type
+    return route.intent, None, [], None
+
+
+def make_corpus(app_module, n: int, long_text: bool, seed: int = 42):
+    rng = random.Random(seed)
+    cities = list(app_module.CITY_MAP)
+    types = app_module.TYPE_KEYWORDS + list(app_module.TYPE_ALIASES)
+    crops = sorted(app_module.crop_data.frame["品項"].astype(str).unique()) + list(app_module.FRUIT_ALIASES)
+    generators = [
+        lambda: rng.choice(list(app_module.MENU_INTENTS)),
+        lambda: f"{rng.randint(1, 12)}月{rng.choice(FILLERS)}{rng.choice(types + [''])}",
+        lambda: f"{rng.choice(CHINESE_MONTHS)}月{rng.choice(FILLERS)}{rng.choice(types + [''])}",
+        lambda: f"{rng.choice(cities)}{rng.choice(['', ' '])}{rng.choice(types + [''])}",
+        lambda: " ".join(rng.sample(cities, 2)),
+        lambda: rng.choice(["、", "，", " "]).join(rng.sample(crops, rng.randint(1, 4))),
+        lambda: f"{rng.choice(crops)}近{rng.randint(3, 60)}天{rng.choice(['均價', '走勢', ''])}",
+        lambda: rng.choice(NOISE),
+    ]
+    corpus = []
+    for _ in range(n):
+        text = rng.choice(generators)()
+        if long_text:
+            text += "，" + "".join(rng.choice(NOISE) for _ in range(10))
+        corpus.append(text)
+    return corpus
+
+
+def time_router(func, corpus, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            func(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="意圖路由效能比較")
+    parser.add_argument("--messages", type=int, default=100000, help="合成訊息數")
+    parser.add_argument("--repeat", type=int, default=3, help="重複次數（取最快一次）")
+    parser.add_argument("--long", action="store_true", help="每則訊息附加一段長文字")
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+
+    corpus = make_corpus(app_module, args.messages, args.long)
+    # 量測時不計入 metrics span 的額外成本
+    route = app_module.route_message.__wrapped__
+
+    mismatches = []
+    for text in corpus:
+        new = route(text)
+        old = legacy_route(app_module, text)
+        if route_summary(new) != old:
+            mismatches.append((text, old, new))
+
+    crop_words = list(dict.fromkeys(list(app_module.crop_data.frame["品項"].astype(str).unique()) + list(app_module.FRUIT_ALIASES)))
+
+    def legacy_with_crops(text):
+        # 舊做法若也要找出訊息中的已知品項，只能對每個品項各做一次 in
+        legacy_route(app_module, text)
+        return [w for w in crop_words if w in text]
+
+    legacy = time_router(lambda text: legacy_route(app_module, text), corpus, args.repeat)
+    legacy_crops = time_router(legacy_with_crops, corpus, args.repeat)
+    compiled = time_router(route, corpus, args.repeat)
+
+    n = len(corpus)
+    print(f"訊息數 {n}，平均長度 {sum(map(len, corpus)) / n:.1f} 字")
+    print(f"{'router':<14}{'total s':>10}{'µs/msg':>10}")
+    print(f"{'legacy':<14}{legacy:>10.3f}{legacy / n * 1e6:>10.2f}")
+    print(f"{'legacy+crops':<14}{legacy_crops:>10.3f}{legacy_crops / n * 1e6:>10.2f}")
+    print(f"{'compiled':<14}{compiled:>10.3f}{compiled / n * 1e6:>10.2f}")
+    print(f"判斷不一致：{len(mismatches)} 則")
+    for text, old, new in mismatches[:10]:
+        print(f"  {text!r}: {old[:2]} → {route_summary(new)[:2]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""上游開放資料抓取（手動執行與本機演練）
+
+app 內的背景執行緒會定期抓取 PRICE_FEED_URL / CROP_FEED_URL；這支程式用來手動抓一次，
+或是啟動本機假上游（提供 repo 內附的 CSV，支援 ETag、If-Modified-Since 與 gzip），
+完整走過「第一次下載 → 304 → 上游發布新資料 → 只合併新增的列 → 304」的流程。
+
+用法：
+    PRICE_FEED_URL=https://... CROP_FEED_URL=https://... python fetch_feeds.py
+    python fetch_feeds.py --stub
+    python fetch_feeds.py --stub --new-days 3 --no-gzip
+"""
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+PRICE_CSV_PATH = "水果產品日交易行情.csv"
+CROP_CSV_PATH = "每月盛產農產品產地.csv"
+# 演練時上游新發布的產期資料（一個原本沒有的品項）
+STUB_NEW_CROP_ROW = "水果,11,演練果,,台東縣,卑南鄉"
+
+
+class StubFeedHandler(BaseHTTPRequestHandler):
+    """假的上游開放資料站：依 If-None-Match / If-Modified-Since 回 304，用戶端接受時以 gzip 傳送"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            entry = self.server.files.get(self.path)
+        if entry is None:
+            self.reply(404, b"not found", {})
+            return
+        body, etag, last_modified = entry
+
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            not_modified = etag in [t.strip() for t in if_none_match.split(",")]
+        elif if_modified_since is not None:
+            try:
+                not_modified = parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(last_modified)
+            except (TypeError, ValueError):
+                not_modified = False
+        else:
+            not_modified = False
+        validators = {"ETag": etag, "Last-Modified": last_modified}
+        if not_modified:
+            self.reply(304, b"", validators)
+            return
+
+        headers = dict(validators, **{"Content-Type": "text/csv; charset=utf-8"})
+        if self.server.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self.reply(200, body, headers)
+
+    def reply(self, status: int, body: bytes, headers):
+        with self.server.lock:
+            self.server.statuses[status] = self.server.statuses.get(status, 0) + 1
+            self.server.bytes_sent += len(body)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_feed(use_gzip: bool = True):
+    """在本機隨機埠啟動假上游，以 server.publish(路徑, 內容) 更新檔案"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubFeedHandler)
+    server.daemon_threads = True
+    server.gzip = use_gzip
+    server.lock = Lock()
+    server.files = {}
+    server.statuses = {}
+    server.bytes_sent = 0
+
+    def publish(path: str, body: bytes):
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+        with server.lock:
+            server.files[path] = (body, etag, formatdate(time.time(), usegmt=True))
+
+    server.publish = publish
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def next_roc_dates(roc_date: str, n: int):
+    """民國日期往後 n 天（例如：114/11/01 → 114/11/02 …）"""
+    year, month, day = (int(x) for x in roc_date.split("/"))
+    start = date(year + 1911, month, day)
+    return [f"{d.year - 1911}/{d.month:02d}/{d.day:02d}" for d in (start + timedelta(days=i + 1) for i in range(n))]
+
+
+def publish_new_days(body: bytes, n_days: int):
+    """以最後一個交易日的行情為範本，在檔案末端附加 n_days 個新交易日"""
+    lines = body.decode("utf-8-sig").splitlines()
+    latest = max(line.split(",", 1)[0] for line in lines[1:] if line.strip())
+    template = [line for line in lines[1:] if line.startswith(latest + ",")]
+    extra = [d + line[len(latest):] for d in next_roc_dates(latest, n_days) for line in template]
+    return ("﻿" + "\n".join(lines + extra) + "\n").encode("utf-8"), len(extra)
+
+
+def run_round(app_module, session, label: str):
+    start = time.perf_counter()
+    results = app_module.fetch_feeds(session)
+    elapsed = (time.perf_counter() - start) * 1000
+    detail = "，".join(
+        f"{f.name}: HTTP {f.last.get('status')} {f.last.get('encoding')} {f.last.get('bytes', 0)} B 新增 {results[f.name]}"
+        for f in app_module.upstream_feeds)
+    print(f"{label:<10}{elapsed:>8.1f} ms  {detail}")
+    return results
+
+
+def run_stub(args):
+    stub = start_stub_feed(use_gzip=not args.no_gzip)
+    base = "http://%s:%d" % stub.server_address
+    with open(PRICE_CSV_PATH, "rb") as f:
+        price_body = f.read()
+    with open(CROP_CSV_PATH, "rb") as f:
+        crop_body = f.read()
+    stub.publish("/price.csv", price_body)
+    stub.publish("/crop.csv", crop_body)
+
+    os.environ["PRICE_FEED_URL"] = base + "/price.csv"
+    os.environ["CROP_FEED_URL"] = base + "/crop.csv"
+    # 演練寫入的行情與使用者狀態另存一份，不影響正式資料庫
+    os.environ.setdefault("PRICE_DB_PATH", os.path.join(tempfile.gettempdir(), "fetch_feeds_price.db"))
+    os.environ.setdefault("SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "fetch_feeds_sessions.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+    import requests
+
+    session = requests.Session()
+    print(f"🧪 假上游 {base}（gzip {'關閉' if args.no_gzip else '開啟'}），"
+          f"行情 {len(price_body)} B、產期 {len(crop_body)} B")
+    rows_before, crops_before = len(app_module.df), len(app_module.crop_data.frame)
+
+    failures = []
+    first = run_round(app_module, session, "第一次")
+    if first != {"price": 0, "crop": 0}:
+        failures.append(f"第一次抓取應沒有新資料（已持有相同內容），實際 {first}")
+
+    unchanged = run_round(app_module, session, "未更新")
+    if any(f.last["status"] != 304 for f in app_module.upstream_feeds) or any(unchanged.values()):
+        failures.append("上游未更新時應回 304")
+
+    new_price, added_price = publish_new_days(price_body, args.new_days)
+    stub.publish("/price.csv", new_price)
+    stub.publish("/crop.csv", crop_body.rstrip(b"\r\n") + ("\n" + STUB_NEW_CROP_ROW + "\n").encode("utf-8"))
+    merged = run_round(app_module, session, "上游發布")
+    if merged != {"price": added_price, "crop": 1}:
+        failures.append(f"應新增行情 {added_price} 筆、產期 1 筆，實際 {merged}")
+
+    again = run_round(app_module, session, "再次抓取")
+    if any(again.values()):
+        failures.append("重複抓取不應再新增資料")
+
+    # 新資料是否已經交給執行中的 app
+    route = app_module.route_message("演練果")
+    reply, found, _ = app_module.render_crop_reply(["演練果"])
+    latest_dates = sorted(app_module.df["日期"].astype(str).unique())[-args.new_days:]
+    print(f"📊 行情 {rows_before} → {len(app_module.df)} 筆（最新交易日 {latest_dates[-1]}），"
+          f"產期 {crops_before} → {len(app_module.crop_data.frame)} 筆")
+    print(f"🔎 「演練果」路由為 {route.intent}，回覆：{reply.strip().splitlines()[0] if found else None}")
+    if "演練果" not in route.crops or not found:
+        failures.append("新品項沒有反映到路由或回覆")
+    if len(app_module.df) != rows_before + added_price:
+        failures.append("行情筆數不符")
+    print(f"🧪 假上游狀態碼 {stub.statuses}，共送出 {stub.bytes_sent} B")
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="上游開放資料抓取")
+    parser.add_argument("--stub", action="store_true", help="對本機假上游演練完整流程")
+    parser.add_argument("--new-days", type=int, default=1, help="演練時上游新發布的交易日數")
+    parser.add_argument("--no-gzip", action="store_true", help="演練時假上游不壓縮")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("PRICE_RELOAD_INTERVAL", "0")
+    os.environ.setdefault("FEED_FETCH_INTERVAL", "0")
+    if args.stub:
+        os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "feed-token")
+        os.environ.setdefault("LINE_CHANNEL_SECRET", "feed-secret")
+        return run_stub(args)
+
+    if not (os.environ.get("PRICE_FEED_URL") or os.environ.get("CROP_FEED_URL")):
+        parser.error("請設定 PRICE_FEED_URL 或 CROP_FEED_URL，或使用 --stub 演練")
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+    import requests
+
+    results = run_round(app_module, requests.Session(), "抓取")
+    return 1 if any(v is None for v in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+"""gunicorn 設定
+
+主行程先載入 app（啟動資料快照、產期索引、行情資料），再 fork 出 worker，
+這些唯讀資料的記憶體分頁由所有 worker 以 copy-on-write 共用，新增 worker 時也不必重新載入。
+
+上游抓取（FEED_FETCH_INTERVAL）刻意在每個 worker 各跑一條執行緒，而不是只由一個行程抓取：
+合併後的行情與產期資料只存在抓取它的 worker 記憶體裡，其他 worker 無從得知，
+改成單一抓取者就得另外把資料廣播給所有 worker。每個 worker 都以 ETag / Last-Modified
+做條件式 GET，上游沒有更新時只會收到 304，N 個 worker 的成本是 N 個空回應。
+worker 數多到上游吃不消時，應拉長 FEED_FETCH_INTERVAL，或改由排程更新行情 CSV，交給行情檔監看（PRICE_RELOAD_INTERVAL）載入。
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+preload_app = True
+
+
+def when_ready(server):
+    # 載入完成的物件移到永久世代：worker 做垃圾回收時不會再寫入這些物件，分頁才能持續共用
+    gc.freeze()
@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app 在 import 時就會讀入資料並建立資料庫：先設定好環境變數，資料庫與快照放到暫存目錄
+_tmp = tempfile.mkdtemp(prefix="haoshi-tests-")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("PRICE_RELOAD_INTERVAL", "0")
+os.environ.setdefault("FEED_FETCH_INTERVAL", "0")
+os.environ.setdefault("DATA_SNAPSHOT", "0")
+os.environ.setdefault("PRICE_DB_PATH", os.path.join(_tmp, "price_history.db"))
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(_tmp, "sessions.db"))
+
+# CSV 以相對路徑讀入
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,38 @@
+import app
+
+
+def test_sqlite_recent_events_shared_between_stores(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    # 兩個 worker 行程各自開啟同一個檔案
+    first = app.SQLiteRecentEvents(path, maxsize=100, ttl=60)
+    second = app.SQLiteRecentEvents(path, maxsize=100, ttl=60)
+    assert not first.seen("01EVENT")
+    assert second.seen("01EVENT")
+    assert not second.seen("01OTHER")
+
+
+def test_sqlite_recent_events_expire(tmp_path):
+    events = app.SQLiteRecentEvents(str(tmp_path / "sessions.db"), maxsize=100, ttl=0)
+    assert not events.seen("01EVENT")
+    # 存活時間為 0，下一次再收到時已過期，視為新事件
+    assert not events.seen("01EVENT")
+
+
+def test_sqlite_recent_events_sweep_keeps_maxsize(tmp_path):
+    events = app.SQLiteRecentEvents(str(tmp_path / "sessions.db"), maxsize=3, ttl=60)
+    for i in range(5):
+        events.seen(f"01EVENT{i}")
+    events.sweep()
+    assert len(events) == 3
+    assert not events.seen("01EVENT0")
+
+
+def test_memory_recent_events():
+    events = app.RecentEvents(maxsize=2, ttl=60)
+    assert not events.seen("01EVENT")
+    assert events.seen("01EVENT")
+    events.seen("01OTHER")
+    events.seen("01THIRD")
+    # 超過上限時最舊的事件被淘汰
+    assert len(events) == 2
+    assert not events.seen("01EVENT")
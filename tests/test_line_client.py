@@ -0,0 +1,50 @@
+import pytest
+
+import app
+from bench_callback import start_stub_server
+
+
+@pytest.fixture
+def stub():
+    server = start_stub_server(latency=0, fail_rate=1.0)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "LINE_RETRY_BACKOFF", 0.001)
+    monkeypatch.setattr(app, "LINE_MAX_RETRIES", 3)
+    monkeypatch.setattr(app, "LINE_RETRY_BUDGET", 5)
+    return app.PooledHttpClient(timeout=1)
+
+
+def reply_url(server):
+    host, port = server.server_address
+    return f"http://{host}:{port}/v2/bot/message/reply"
+
+
+def test_retries_5xx_and_429_until_max_retries(stub, client):
+    response = client.post(reply_url(stub), data=b"{}")
+    assert response.status_code in (429, 500)
+    # 第一次 + LINE_MAX_RETRIES 次重試
+    assert stub.requests == 4
+
+
+def test_success_is_not_retried(stub, client):
+    stub.fail_rate = 0
+    assert client.post(reply_url(stub), data=b"{}").status_code == 200
+    assert stub.requests == 1
+
+
+def test_budget_includes_attempt_timeout(stub, client, monkeypatch):
+    # 預算比一次請求的逾時還短，下一次重試可能超過期限，因此不重試
+    monkeypatch.setattr(app, "LINE_RETRY_BUDGET", 0.5)
+    client.post(reply_url(stub), data=b"{}")
+    assert stub.requests == 1
+
+
+def test_no_retry_inside_webhook_request(stub, client):
+    with app.app.test_request_context("/callback"):
+        client.post(reply_url(stub), data=b"{}")
+    assert stub.requests == 1
@@ -0,0 +1,33 @@
+import app
+
+
+def make_shedder(user_rate=1e-6, user_burst=2, global_rate=0, global_burst=0, max_users=100, notice_interval=60):
+    return app.LoadShedder(user_rate, user_burst, global_rate, global_burst, max_users, notice_interval)
+
+
+def test_user_burst_then_degrade_once_then_drop():
+    shedder = make_shedder()
+    assert [shedder.admit("U1") for _ in range(4)] == ["ok", "ok", "degrade", "drop"]
+    # 其他使用者有自己的令牌桶
+    assert shedder.admit("U2") == "ok"
+    assert shedder.stats()["user_degrade"] == 1
+    assert shedder.stats()["user_drop"] == 1
+
+
+def test_notice_repeats_after_interval():
+    shedder = make_shedder(user_burst=1, notice_interval=0)
+    assert [shedder.admit("U1") for _ in range(3)] == ["ok", "degrade", "degrade"]
+
+
+def test_global_bucket_shared_by_all_users():
+    shedder = make_shedder(user_rate=0, global_rate=1e-6, global_burst=1)
+    assert shedder.admit("U1") == "ok"
+    assert shedder.admit("U2") == "degrade"
+    assert shedder.stats()["global_degrade"] == 1
+
+
+def test_tracked_users_bounded():
+    shedder = make_shedder(max_users=3)
+    for i in range(10):
+        shedder.admit(f"U{i}")
+    assert shedder.stats()["tracked_users"] == 3
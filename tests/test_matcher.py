@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def matcher():
+    return app.NGramMatcher({"芒果": 3, "芥菜": 3, "柿子": 3, "酪梨": 3, "火龍果": 3, "鳳梨釋迦": 3, "蓮霧": 3})
+
+
+@pytest.mark.parametrize("word, expected", [
+    ("火龍", "火龍果"),
+    ("鳳梨釋加", "鳳梨釋迦"),
+    ("蓮霧霧", "蓮霧"),
+])
+def test_suggest_hits(matcher, word, expected):
+    assert matcher.suggest(word, app.suggest_cutoff(word))[0] == expected
+
+
+@pytest.mark.parametrize("word", ["水果", "蔬菜", "桃子", "柚子", "水梨", "蘋果", "芒果"])
+def test_suggest_short_input_needs_more_than_one_shared_char(matcher, word):
+    # 只共用一個字的兩字詞（水果／芒果）不提示；與輸入相同也不提示
+    assert matcher.suggest(word, app.suggest_cutoff(word)) == (None, 0.0)
+
+
+def test_suggest_accept_filters_candidates(matcher):
+    assert matcher.suggest("火龍", 0.5, accept=lambda word: word != "火龍果") == (None, 0.0)
+
+
+def test_vocabulary_skips_variety_numbers():
+    assert not [word for word in app.build_crop_vocabulary() if any(c.isdigit() for c in word)]
+
+
+def search_reply(monkeypatch, text):
+    """以即時資訊模式送出一則訊息，回傳回覆文字"""
+    replies = []
+    monkeypatch.setattr(app.line_bot_api, "reply_message", lambda token, messages: replies.extend(
+        messages if isinstance(messages, list) else [messages]))
+    app.user_state["U-search"] = "search"
+    event = SimpleNamespace(reply_token="reply-token", source=SimpleNamespace(user_id="U-search"),
+                            message=SimpleNamespace(text=text))
+    app.handle_message(event)
+    return "".join(message.text for message in replies)
+
+
+def test_search_expands_aliases(monkeypatch):
+    # 即時資訊模式也要認得同義詞：芭樂 → 番石榴
+    assert "番石榴" in search_reply(monkeypatch, "芭樂")
+
+
+def test_search_hint_only_for_price_names(monkeypatch):
+    # 品種編號「13」查不到行情名稱，不提示
+    assert search_reply(monkeypatch, "13月") == "查無「13月」的市場價格資料。"
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+SEPARATOR = "-" * 21
+
+
+def entry(i):
+    return f"🍎 品項{i}：" + "、".join(f"品種{i}-{j}" for j in range(6)) + "\n" + SEPARATOR + "\n"
+
+
+def test_short_text_is_one_page():
+    assert app.paginate_text("芒果\n" + SEPARATOR, 120) == ("芒果\n" + SEPARATOR,)
+
+
+@pytest.mark.parametrize("max_chars", [60, 80, 100, 120, 200])
+def test_pages_split_between_entries(max_chars):
+    text = "".join(entry(i) for i in range(12))
+    pages = app.paginate_text(text, max_chars)
+    assert len(pages) > 1
+    for page in pages:
+        assert len(page) <= max_chars - app.PAGE_FOOTER_RESERVE
+        # 不會有以分隔線開頭（或只剩分隔線）的頁面
+        assert not app.PAGE_SEPARATOR_PATTERN.match(page.splitlines()[0].strip())
+    # 除了切點上省略的分隔線，內容都還在
+    assert "".join(pages).replace(SEPARATOR, "").replace("\n", "") == text.replace(SEPARATOR, "").replace("\n", "")
+
+
+def test_long_entry_split_at_commas():
+    pieces = app.split_long_entry("、".join(["芒果"] * 30) + "\n" + SEPARATOR + "\n", 20)
+    assert all(len(piece) <= 20 for piece in pieces)
+    assert not any(app.PAGE_SEPARATOR_PATTERN.match(piece.strip()) for piece in pieces)
+
+
+def test_next_page_cursor_round_trip(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "send_reply", lambda token, messages: sent.append(
+        [m.text for m in messages] if isinstance(messages, list) else [messages.text]))
+    event = SimpleNamespace(reply_token="reply-token")
+    pages = app.paginate_text("".join(entry(i) for i in range(12)), 120)
+    total = -(-len(pages) // app.REPLY_MAX_MESSAGES)
+    assert total > 1
+
+    app.send_pages(event, "U-pages", pages)
+    for _ in range(total - 1):
+        app.reply_next_page(event, "U-pages", None)
+    assert [text for batch in sent for text in batch][-1].endswith(f"第 {total}/{total} 頁（已顯示全部）")
+    assert sum(len(batch) for batch in sent) == len(pages)
+    assert f"第 1/{total} 頁" in sent[0][-1]
+
+    # 游標用完後再輸入「下一頁」
+    app.reply_next_page(event, "U-pages", None)
+    assert sent[-1] == ["目前沒有更多資料了，請重新輸入查詢內容。"]
@@ -0,0 +1,14 @@
+import app
+
+
+def test_markets_cached_until_ingest(tmp_path):
+    store = app.PriceHistoryStore(str(tmp_path / "price_history.db"))
+    store.ingest(app.df)
+    markets = store.markets()
+    assert store.markets() is markets
+
+    frame = app.df.head(1).copy()
+    frame["市場"] = "999 測試市場"
+    store.ingest(frame)
+    assert "測試市場" in store.markets()
+    assert set(markets) < set(store.markets())
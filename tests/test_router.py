@@ -0,0 +1,73 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("text, months", [
+    ("7月有什麼水果", [7]),
+    ("12 月", [12]),
+    ("7、8月", [7, 8]),
+    ("7和8月盛產", [7, 8]),
+    ("7到9月", [7, 8, 9]),
+    ("11~2月", [11, 12, 1, 2]),
+    ("7月和8月", [7, 8]),
+    ("三月", [3]),
+    ("十月", [10]),
+    ("十一月", [11]),
+    ("十二月蔬菜", [12]),
+    ("十二月和7月", [7, 12]),
+    ("0月", []),
+    ("香蕉", []),
+    ("7號", []),
+])
+def test_extract_months(text, months):
+    assert app.extract_months(text) == months
+
+
+def test_month_route():
+    route = app.route_message("十一月有什麼果類")
+    assert (route.intent, route.month, route.months, route.crop_type) == ("month", 11, [11], "水果")
+
+
+def test_now_keyword_uses_current_month(monkeypatch):
+    monkeypatch.setattr(app, "current_month", lambda: 4)
+    route = app.route_message("現在有什麼水果")
+    assert (route.intent, route.month, route.crop_type) == ("month", 4, "水果")
+
+
+def test_now_keyword_with_crop_stays_crop_query():
+    route = app.route_message("當季香蕉")
+    assert (route.intent, route.crops) == ("crop", ["香蕉"])
+
+
+def test_region_route():
+    route = app.route_message("高雄 臺中 蔬菜")
+    # 地區依 CITY_MAP 的順序排列
+    assert (route.intent, route.regions, route.crop_type) == ("region", ["台中市", "高雄市"], "蔬菜")
+
+
+def test_menu_route():
+    assert app.route_message("輔助工具").intent == "tools"
+
+
+@pytest.mark.parametrize("text, crops", [
+    ("香蕉", ["香蕉"]),
+    ("香蕉芭樂", ["香蕉", "芭樂"]),
+    ("香蕉、芭樂", ["香蕉", "芭樂"]),
+    ("火龍果", ["火龍果"]),
+    ("你好", []),
+])
+def test_extract_crops(text, crops):
+    assert app.extract_crops(text) == crops
+    assert app.route_message(text).crops == crops
+
+
+def test_crop_pattern_prefers_longest_item():
+    # 「鳳梨釋迦」同時包含「鳳梨」與「釋迦」，同一位置取最長的品項
+    assert app.extract_crops("我想吃鳳梨和鳳梨釋迦") == ["鳳梨", "鳳梨釋迦"]
+
+
+def test_history_route():
+    route = app.route_message("芭樂近7天均價")
+    assert route.intent == "history"
+    assert route.history[:2] == ("芭樂", 7)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("value, months", [
+    ("1、2", [1, 2]),
+    ("5~6月", [5, 6]),
+    ("12~4月", [12, 1, 2, 3, 4]),
+    ("7月~翌年2月", [7, 8, 9, 10, 11, 12, 1, 2]),
+    ("11~2月", [11, 12, 1, 2]),
+    ("1~3月、5~9月", [1, 2, 3, 5, 6, 7, 8, 9]),
+    ("7月~9月", [7, 8, 9]),
+    ("13月", []),
+    ("0~3月", []),
+    ("", []),
+])
+def test_parse_month_expression(value, months):
+    assert app.parse_month_expression(value) == months
+
+
+def test_wrap_around_mask():
+    mask = app.parse_season_mask("11~2月")
+    assert mask == app.months_to_mask([1, 2, 11, 12])
+    assert app.mask_to_months(mask) == [1, 2, 11, 12]
+
+
+def test_season_positions_match_all_months():
+    positions = app.season_positions([12, 1])
+    assert len(positions)
+    required = app.months_to_mask([12, 1])
+    assert all(int(mask) & required == required for mask in app.crop_data.masks[positions])
+    # 兩個月都要在產期內，結果是只查一月的子集合
+    assert set(positions) <= set(app.season_positions([1]))
+
+
+def test_season_positions_wrap_around_items():
+    # 東部時令水果：鳳梨釋迦 12~4 月、桶柑 11~2 月跨年，臍橙 11~12 月不含一月
+    items = app.season_items(app.season_positions([12, 1]))
+    assert {"鳳梨釋迦", "桶柑"} <= set(items)
+    assert "臍橙" not in app.season_items(app.season_positions([1]))
+
+
+@pytest.mark.parametrize("months", [[], [0], [13], [1, 13]])
+def test_season_positions_invalid_months(months):
+    positions = app.season_positions(months)
+    assert isinstance(positions, np.ndarray) and not len(positions)
+
+
+def test_season_positions_type_filter():
+    fruit = app.season_positions([7], crop_type="水果")
+    assert set(fruit) <= set(app.season_positions([7]))
+    assert set(app.crop_data.table["類型"].iloc[fruit].astype(str)) == {"水果"}
@@ -0,0 +1,55 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(maxsize=100, ttl=60):
+        if request.param == "memory":
+            return app.MemorySessionStore(maxsize, ttl)
+        return app.SQLiteSessionStore(str(tmp_path / "sessions.db"), maxsize, ttl)
+    return make
+
+
+def test_set_get_and_clear(make_store):
+    store = make_store()
+    assert store.get("U1") is None
+    store["U1"] = "search"
+    assert store.get("U1") == "search"
+    store["U1"] = None
+    assert store.get("U1", "gone") == "gone"
+
+
+def test_expired_state_is_gone(make_store):
+    store = make_store(ttl=0)
+    store["U1"] = "search"
+    assert store.get("U1") is None
+
+
+def test_evicts_least_recent_user(make_store):
+    store = make_store(maxsize=2)
+    for user_id in ("U1", "U2", "U3"):
+        store[user_id] = "search"
+    if isinstance(store, app.SQLiteSessionStore):
+        # SQLite 每 SWEEP_EVERY 次寫入才檢查一次上限
+        store.sweep()
+    assert len(store) == 2
+    assert store.get("U1") is None
+    assert store.get("U3") == "search"
+
+
+def test_sqlite_store_shared_between_workers(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first = app.SQLiteSessionStore(path, 100, 60)
+    second = app.SQLiteSessionStore(path, 100, 60)
+    first["U1"] = "search"
+    assert second.get("U1") == "search"
+
+
+def test_sqlite_store_sweeps_periodically(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.SQLiteSessionStore, "SWEEP_EVERY", 5)
+    store = app.SQLiteSessionStore(str(tmp_path / "sessions.db"), 3, 60)
+    for i in range(5):
+        store[f"U{i}"] = "search"
+    assert len(store) == 3
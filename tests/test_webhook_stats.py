@@ -0,0 +1,18 @@
+from threading import Thread
+
+import app
+
+
+def test_webhook_stats_counted_from_many_threads():
+    before = app.webhook_stats_snapshot()["processed"]
+
+    def work():
+        for _ in range(5000):
+            app.count_webhook_event("processed")
+
+    threads = [Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert app.webhook_stats_snapshot()["processed"] - before == 8 * 5000
@@ -0,0 +1,199 @@
+"""本周水果報批次推播
+
+行情與產期資料只計算、排版一次，再以 multicast 分批（每批最多 500 人）推給追蹤者。
+送出時限制同時請求數與每秒請求數，每完成一批就寫入進度檔，中斷後重跑會從未完成的批次繼續；
+每批帶固定的 X-Line-Retry-Key，就算同一批被重送，LINE 也只會推播一次。
+
+用法：
+    python weekly_digest.py --followers                      # 取得所有追蹤者後推播
+    python weekly_digest.py --recipients users.txt           # 每行一個 userId
+    python weekly_digest.py --dry-run --synthetic 5000       # 對本機假 LINE API 演練，不會真的送出
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+from threading import Lock
+
+MULTICAST_MAX_RECIPIENTS = 500
+MULTICAST_PATH = "/v2/bot/message/multicast"
+DEFAULT_PROGRESS_PATH = "weekly_digest_progress.json"
+
+
+class RateLimiter:
+    """簡單的固定間隔限速器：任兩次 acquire 之間至少相隔 1/rate 秒"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def chunked(items, size: int):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def default_digest_id():
+    """預設以 ISO 週次當作這一期的識別碼，例如 2025-W44"""
+    year, week, _ = date.today().isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def load_recipients(args, line_bot_api):
+    """依參數取得收件者，去除重複並排序，讓批次切法在重跑時保持一致"""
+    if args.recipients:
+        with open(args.recipients, encoding="utf-8") as f:
+            users = [line.strip() for line in f if line.strip()]
+    elif args.followers:
+        users, start = [], None
+        while True:
+            page = line_bot_api.get_followers_ids(limit=1000, start=start)
+            users.extend(page.user_ids)
+            start = page.next
+            if not start:
+                break
+    else:
+        users = [f"U{i:032x}" for i in range(args.synthetic)]
+    return sorted(set(users))
+
+
+def load_progress(path: str, digest_id: str, total_chunks: int):
+    """讀取進度檔；期別或批次數不同時視為新的一輪"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if data.get("digest_id") != digest_id or data.get("total_chunks") != total_chunks:
+        return set()
+    return set(data.get("done", []))
+
+
+def save_progress(path: str, digest_id: str, total_chunks: int, done):
+    """先寫暫存檔再 os.replace，避免中斷時留下寫到一半的進度檔"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"digest_id": digest_id, "total_chunks": total_chunks, "done": sorted(done)}, f)
+    os.replace(tmp, path)
+
+
+def multicast_chunk(app_module, payload_messages, user_ids, retry_key: str):
+    """送出一批 multicast，回傳 HTTP 狀態碼
+
+    不走 LineBotApi.multicast：SDK 會把 X-Line-Retry-Key 寫進共用的 headers，
+    多執行緒同時送出時會互相覆蓋，所以這裡每次請求自己帶 header。
+    """
+    api = app_module.line_bot_api
+    headers = {k: v for k, v in api.headers.items() if k.lower() != "x-line-retry-key"}
+    headers["Content-Type"] = "application/json"
+    headers["X-Line-Retry-Key"] = retry_key
+    body = json.dumps({"to": user_ids, "messages": payload_messages}, ensure_ascii=False)
+    response = api.http_client.post(app_module.LINE_API_ENDPOINT + MULTICAST_PATH,
+                                     headers=headers, data=body.encode("utf-8"))
+    return response.status_code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本周水果報批次推播")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--recipients", help="收件者清單檔，每行一個 userId")
+    source.add_argument("--followers", action="store_true", help="從 LINE API 取得所有追蹤者")
+    source.add_argument("--synthetic", type=int, default=0, help="產生 N 個假 userId（搭配 --dry-run 演練）")
+    parser.add_argument("--chunk-size", type=int, default=MULTICAST_MAX_RECIPIENTS, help="每批收件人數（上限 500）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時送出的批次數")
+    parser.add_argument("--rate", type=float, default=50.0, help="每秒最多送出的 multicast 請求數")
+    parser.add_argument("--digest-id", default=None, help="這一期的識別碼，預設為 ISO 週次")
+    parser.add_argument("--progress", default=DEFAULT_PROGRESS_PATH, help="進度檔路徑")
+    parser.add_argument("--dry-run", action="store_true", help="改送到本機假 LINE API")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="dry-run 假 API 的模擬延遲（秒）")
+    parser.add_argument("--stub-fail-rate", type=float, default=0.0, help="dry-run 假 API 回 500/429 的機率")
+    args = parser.parse_args(argv)
+
+    if not (args.recipients or args.followers or args.synthetic):
+        parser.error("請指定 --recipients、--followers 或 --synthetic 其中之一")
+    if args.followers and args.dry_run:
+        parser.error("--dry-run 的假 API 不提供追蹤者清單，請改用 --synthetic 或 --recipients")
+    chunk_size = max(1, min(args.chunk_size, MULTICAST_MAX_RECIPIENTS))
+
+    stub = None
+    if args.dry_run:
+        from bench_callback import start_stub_server
+        os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "dry-run-token")
+        os.environ.setdefault("LINE_CHANNEL_SECRET", "dry-run-secret")
+        os.environ.setdefault("LINE_RETRY_BACKOFF", "0.01")
+        stub = start_stub_server(args.stub_latency, args.stub_fail_rate)
+        os.environ["LINE_API_ENDPOINT"] = "http://%s:%d" % stub.server_address
+        print(f"🧪 dry-run：改送到本機假 LINE API {os.environ['LINE_API_ENDPOINT']}")
+    os.environ.setdefault("PRICE_RELOAD_INTERVAL", "0")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+    from linebot.models import TextSendMessage
+
+    # 內容只產生一次，所有批次共用同一份 payload
+    start = time.perf_counter()
+    digest = app_module.render_weekly_digest()
+    payload_messages = [TextSendMessage(text=digest).as_json_dict()]
+    print(f"📰 已產生本周水果報（{len(digest)} 字，{(time.perf_counter() - start) * 1000:.1f} ms）")
+
+    digest_id = args.digest_id or default_digest_id()
+    users = load_recipients(args, app_module.line_bot_api)
+    chunks = chunked(users, chunk_size)
+    done = load_progress(args.progress, digest_id, len(chunks))
+    pending = [i for i in range(len(chunks)) if i not in done]
+    print(f"👥 收件者 {len(users)} 人，共 {len(chunks)} 批，已完成 {len(done)} 批，待送 {len(pending)} 批")
+
+    limiter = RateLimiter(args.rate)
+    progress_lock = Lock()
+    failed = {}
+
+    def send(index: int):
+        limiter.acquire()
+        retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"haoshi-weekly:{digest_id}:{index}"))
+        try:
+            return index, multicast_chunk(app_module, payload_messages, chunks[index], retry_key)
+        except Exception as e:
+            return index, repr(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        for future in as_completed([pool.submit(send, i) for i in pending]):
+            index, status = future.result()
+            # 409 代表同一個 retry key 已經被接受過，視為完成
+            if isinstance(status, int) and (200 <= status < 300 or status == 409):
+                with progress_lock:
+                    done.add(index)
+                    save_progress(args.progress, digest_id, len(chunks), done)
+            else:
+                failed[index] = status
+    elapsed = time.perf_counter() - start
+
+    sent = len(pending) - len(failed)
+    print(f"✅ 本次送出 {sent} 批，失敗 {len(failed)} 批，耗時 {elapsed:.2f} 秒"
+          f"（{sent / elapsed if elapsed > 0 else 0:.1f} 批/秒）")
+    if stub is not None:
+        print(f"🧪 假 API 收到 {stub.requests} 次請求，{stub.connections} 條連線，狀態碼 {stub.statuses}")
+    if failed:
+        print(f"❌ 失敗批次：{sorted(failed)[:20]}，重跑同一指令即可續傳")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())